@@ -2,10 +2,32 @@
 
 import subprocess
 import collections
+import concurrent.futures
+import functools
 import pathlib
 import datetime
+import hashlib
+import tempfile
+import atexit
 import re
 import json
+import codecs
+import base64
+import bisect
+import math
+import random
+import contextlib
+import gzip
+import heapq
+import copy
+import array
+import shlex
+import signal
+import threading
+import time
+import uuid
+import queue
+import sqlite3
 
 import yaml
 import flask
@@ -18,7 +40,7 @@ import flask_socketio
 
 import pty
 import os
-import select
+import selectors
 import termios
 import struct
 import fcntl
@@ -26,32 +48,770 @@ import fcntl
 
 app = flask.Flask(__name__)
 app.config["SECRET_KEY"] = "secret!"
-app.config["fd"] = None
-app.config["child_pid"] = None
-app.config["cmd"] = "false"
-app.config["term_proc_exit"] = False
 socketio = flask_socketio.SocketIO(app)
 
 
 def lines_words(text):
     """Return array of lines split into array of words."""
     out = list()
-    for line in text.decode().split("\n"):
+    for line in text.split("\n"):
         out.append(line.split())
     return out
 
 
+SECTION_MARKER = "@@sc:"
+
+
+def section_script(name, command):
+    """Return shell code printing a section header followed by command output."""
+    return f"echo '{SECTION_MARKER}{name}'; {command}\n"
+
+
+def split_sections(text):
+    """Split the output of a batched script into a dict of section name -> text."""
+    sections = dict()
+    name = None
+    for line in text.split("\n"):
+        if line.startswith(SECTION_MARKER):
+            name = line[len(SECTION_MARKER) :]
+            sections[name] = []
+        elif name is not None:
+            sections[name].append(line)
+    return {name: "\n".join(lines) for name, lines in sections.items()}
+
+
+SYSTEMCTL_SHOW_PROPERTIES = [
+    "LoadState",
+    "ActiveState",
+    "SubState",
+    "StateChangeTimestampMonotonic",
+    "MainPID",
+    "MemoryCurrent",
+    "CPUUsageNSec",
+]
+
+
+def services_status_script(services, uptime=True):
+    """Return the shell script printing the state of all services with one call.
+
+    /proc/uptime is printed too so that the monotonic state change timestamps
+    can be turned into an age without depending on the clocks agreeing. Pass
+    uptime=False if the script it's added to already prints it.
+    """
+    names = " ".join(shlex.quote(service.name) for service in services)
+    properties = ",".join(SYSTEMCTL_SHOW_PROPERTIES)
+    script = section_script("show", f"systemctl show --no-page -p {properties} {names}")
+    if uptime:
+        script = section_script("proc_uptime", "cat /proc/uptime") + script
+    return script
+
+
+def parse_systemctl_show(text):
+    """Return a list of property dicts, one per unit, from systemctl show output.
+
+    Units are printed in the order they were asked for, separated by blank lines.
+    """
+    units = []
+    props = dict()
+    for line in text.split("\n"):
+        if not line.strip():
+            if props:
+                units.append(props)
+                props = dict()
+            continue
+        key, _, value = line.partition("=")
+        props[key] = value
+    if props:
+        units.append(props)
+    return units
+
+
+def format_ago(seconds):
+    """Format a number of seconds like systemctl status does, e.g. '2 days ago'."""
+    if seconds >= 86400:
+        return f"{int(seconds // 86400)} days ago"
+    if seconds >= 3600:
+        return f"{int(seconds // 3600)}h ago"
+    if seconds >= 60:
+        return f"{int(seconds // 60)}min ago"
+    return f"{int(seconds)}s ago"
+
+
+def format_uptime(seconds):
+    """Format an uptime like uptime(1) does, e.g. '3 days', '2:03' or '5 min'."""
+    days = int(seconds // 86400)
+    if days:
+        return f"{days} day{'s' if days > 1 else ''}"
+    hours = int(seconds % 86400 // 3600)
+    minutes = int(seconds % 3600 // 60)
+    if hours:
+        return f"{hours}:{minutes:02}"
+    return f"{minutes} min"
+
+
+def is_reported_disk(device, mounted_on):
+    """Return True if a filesystem is one shown on the dashboard."""
+    if mounted_on == "/boot/efi":
+        return False
+    return device.startswith(("/dev/sd", "/dev/mapper", "/dev/vd", "/dev/root"))
+
+
+def parse_df(text):
+    """Return [device, mount point, used kB, available kB] from df -P -k output."""
+    rows = []
+    for words in lines_words(text)[1:]:
+        if words:
+            rows.append([words[0], " ".join(words[5:]), int(words[2]), int(words[3])])
+    return rows
+
+
+def parse_counter(value):
+    """Return a systemd accounting counter as int, or None if it isn't set."""
+    if not value or not value.isdigit() or int(value) >= 2**63:
+        return None
+    return int(value)
+
+
+class CollectionCancelled(Exception):
+    """Raised when a poll cycle is cancelled before it finished."""
+
+
+def check_output_by(cmd, deadline, **kwargs):
+    """Run cmd and return its output, giving up at the deadline (epoch seconds)."""
+    return subprocess.check_output(
+        cmd, timeout=max(deadline - time.time(), 0.1), **kwargs
+    )
+
+
+def fan_out(tasks):
+    """Run callables on a thread pool bounded by cfg_parallelism.
+
+    Returns when every started task has finished. Tasks still queued when
+    the collection is cancelled are dropped. Each task is expected to bound
+    its own run time with a deadline.
+    """
+    if not tasks:
+        return
+    workers = min(cfg_parallelism, len(tasks))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(task) for task in tasks]
+        for future in concurrent.futures.as_completed(futures):
+            if collection_cancelled.is_set():
+                executor.shutdown(wait=False, cancel_futures=True)
+                break
+            if future.exception():
+                print(f"collection task failed: {future.exception()}")
+
+
+def cancel_collection():
+    """Cancel the poll cycle in progress, if any."""
+    collection_cancelled.set()
+
+
+PERF_BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000]
+PERF_BUCKETS_MS += [2500, 5000, 10000, 30000]
+# number of samples tagged with a node or service kept for the slowest lists
+PERF_RECENT = 1000
+
+
+class PerfSeries:
+    """Latency histogram of one kind of work, in PERF_BUCKETS_MS buckets."""
+
+    def __init__(self):
+        """Initialize class variables."""
+        self.counts = [0] * (len(PERF_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        """Count a sample."""
+        self.counts[bisect.bisect_left(PERF_BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q):
+        """Return the upper bound of the bucket holding the q quantile."""
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= q * self.count:
+                return PERF_BUCKETS_MS[i] if i < len(PERF_BUCKETS_MS) else self.max_ms
+        return 0
+
+    def summary(self):
+        """Return the histogram and its percentiles as a dict."""
+        bounds = [f"<={b}" for b in PERF_BUCKETS_MS] + [f">{PERF_BUCKETS_MS[-1]}"]
+        return {
+            "count": self.count,
+            "mean_ms": self.total_ms / self.count if self.count else 0,
+            "p50_ms": self.percentile(0.5),
+            "p90_ms": self.percentile(0.9),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": self.max_ms,
+            "buckets": dict(zip(bounds, self.counts)),
+        }
+
+
+class Perf:
+    """Latency histograms of sc's own work, cheap enough to always be on.
+
+    Samples are grouped by kind ("phase" for local work, "command" for
+    remote commands and "request" for http requests) and name. Recent
+    samples tagged with a node or service are kept to list the slowest.
+    """
+
+    def __init__(self):
+        """Initialize class variables."""
+        self.series = collections.defaultdict(PerfSeries)
+        self.recent = collections.deque(maxlen=PERF_RECENT)
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def record(self, kind, name, seconds, node=None, service=None):
+        """Add a sample of seconds to the kind/name histogram."""
+        ms = seconds * 1000
+        with self.lock:
+            self.series[(kind, name)].add(ms)
+            if node or service:
+                self.recent.append((time.time(), kind, name, ms, node, service))
+
+    @contextlib.contextmanager
+    def timed(self, kind, name, node=None, service=None):
+        """Record how long the with block takes."""
+        time_now = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(kind, name, time.perf_counter() - time_now, node, service)
+
+    def slowest(self, kind, count=15):
+        """Return the slowest recent tagged samples of a kind."""
+        with self.lock:
+            samples = [x for x in self.recent if x[1] == kind]
+        samples.sort(key=lambda x: x[3], reverse=True)
+        return [
+            {"time": t, "name": name, "ms": ms, "node": node, "service": service}
+            for t, _, name, ms, node, service in samples[:count]
+        ]
+
+    def slowest_nodes(self, count=15):
+        """Return the nodes whose recent remote commands were slowest on average."""
+        by_node = collections.defaultdict(list)
+        with self.lock:
+            for _, kind, _, ms, node, _ in self.recent:
+                if kind == "command" and node:
+                    by_node[node].append(ms)
+        nodes = [
+            {
+                "node": node,
+                "count": len(ms),
+                "mean_ms": sum(ms) / len(ms),
+                "max_ms": max(ms),
+            }
+            for node, ms in by_node.items()
+        ]
+        nodes.sort(key=lambda x: x["mean_ms"], reverse=True)
+        return nodes[:count]
+
+    def report(self):
+        """Return everything recorded, for the debug page and its json."""
+        with self.lock:
+            series = [
+                {"kind": kind, "name": name, **series.summary()}
+                for (kind, name), series in sorted(self.series.items())
+            ]
+        return {
+            "since": self.started,
+            "series": series,
+            "slowest_commands": self.slowest("command"),
+            "slowest_phases": self.slowest("phase"),
+            "slowest_nodes": self.slowest_nodes(),
+        }
+
+
+perf = Perf()
+
+
+class TransportError(Exception):
+    """Raised when a remote command couldn't be run or didn't succeed."""
+
+
+class SSHPool:
+    """Pool of persistent multiplexed ssh master connections, one per node.
+
+    Remote commands go through the node's master connection (ssh
+    ControlMaster) instead of doing a full tcp and key exchange every time.
+    Masters are health checked every check_interval seconds, re-established
+    when they die and closed after idle_timeout seconds without use.
+
+    This is the transport all remote commands go through (see the
+    transport global); fake_fleet.FakeFleet implements the same methods
+    for a simulated fleet.
+    """
+
+    def __init__(self, control_dir, idle_timeout=600, check_interval=60):
+        """Initialize class variables."""
+        self.control_dir = pathlib.Path(control_dir)
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.masters = dict()
+        self.node_locks = collections.defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reuses = 0
+        self.reconnects = 0
+        self.failures = 0
+
+    def control_path(self, node_name):
+        """Return the control socket path for node (kept short for unix sockets)."""
+        digest = hashlib.sha1(node_name.encode()).hexdigest()[:16]
+        return str(self.control_dir / digest)
+
+    def ssh_options(self, node_name):
+        """Return ssh options that use the node's master connection if there is one."""
+        return [
+            f"-oControlPath={self.control_path(node_name)}",
+            "-oControlMaster=no",
+            "-oConnectTimeout=3",
+        ]
+
+    def argv(self, node_name, *args):
+        """Return an ssh command line running args on node."""
+        return ["ssh", *self.ssh_options(node_name), "root@" + node_name, *args]
+
+    def command(self, node_name, *args):
+        """Make sure node has a master connection and return an ssh command line."""
+        self.acquire(node_name)
+        return self.argv(node_name, *args)
+
+    def run(self, node_name, *args, deadline):
+        """Run a command on node and return its output, by the deadline.
+
+        Raises TransportError if the command fails or the deadline passes.
+        """
+        try:
+            return check_output_by(
+                self.command(node_name, *args), deadline, stderr=subprocess.STDOUT
+            ).decode()
+        except subprocess.CalledProcessError as e:
+            raise TransportError(e.output.decode().strip() or str(e))
+        except subprocess.TimeoutExpired as e:
+            raise TransportError(str(e))
+
+    def run_script(self, node_name, script, deadline):
+        """Return the output of a shell script run on node, by the deadline.
+
+        Raises TransportError if the node can't be reached, the script fails
+        or the deadline passes.
+        """
+        if not self.acquire(node_name):
+            raise TransportError(f"can't connect to {node_name}")
+        try:
+            return check_output_by(self.argv(node_name, script), deadline).decode()
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            raise TransportError(str(e))
+
+    def script_prefix(self, node_name, program):
+        """Return 'ssh' or 'scp' with multiplexing options, for generated scripts."""
+        self.acquire(node_name)
+        return " ".join([program] + self.ssh_options(node_name))
+
+    def _control(self, node_name, operation):
+        """Send a control command (check, exit) to the node's master."""
+        cmd = [
+            "ssh",
+            "-O",
+            operation,
+            f"-oControlPath={self.control_path(node_name)}",
+            "root@" + node_name,
+        ]
+        try:
+            p = subprocess.run(
+                cmd,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=5,
+            )
+        except subprocess.TimeoutExpired:
+            return False
+        return p.returncode == 0
+
+    def _start_master(self, node_name):
+        """Start a backgrounded master connection to node."""
+        self.control_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        control_path = pathlib.Path(self.control_path(node_name))
+        if control_path.exists():
+            # left over from a previous run: adopt it if alive, else remove it
+            if self._control(node_name, "check"):
+                return True
+            control_path.unlink(missing_ok=True)
+        cmd = [
+            "ssh",
+            "-fN",
+            "-oControlMaster=yes",
+            f"-oControlPath={control_path}",
+            "-oControlPersist=yes",
+            "-oConnectTimeout=3",
+            "root@" + node_name,
+        ]
+        try:
+            p = subprocess.run(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=cfg_node_timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return False
+        return p.returncode == 0
+
+    def acquire(self, node_name):
+        """Return True if node has a live master, (re)starting it if needed."""
+        with self.lock:
+            node_lock = self.node_locks[node_name]
+        with node_lock:
+            now = time.time()
+            master = self.masters.get(node_name)
+            reconnect = False
+            if master and now - master["last_check"] > self.check_interval:
+                if self._control(node_name, "check"):
+                    master["last_check"] = now
+                else:
+                    del self.masters[node_name]
+                    master = None
+                    reconnect = True
+            if master:
+                master["last_used"] = now
+                with self.lock:
+                    self.reuses += 1
+                return True
+            ok = self._start_master(node_name)
+            with self.lock:
+                if not ok:
+                    self.failures += 1
+                    return False
+                self.opened += 1
+                if reconnect:
+                    self.reconnects += 1
+            self.masters[node_name] = {
+                "started": now,
+                "last_used": now,
+                "last_check": now,
+            }
+            return True
+
+    def release(self, node_name):
+        """Close the node's master connection."""
+        with self.lock:
+            node_lock = self.node_locks[node_name]
+        with node_lock:
+            if self.masters.pop(node_name, None) is not None:
+                self._control(node_name, "exit")
+
+    def expire_idle(self):
+        """Close master connections that haven't been used for idle_timeout."""
+        now = time.time()
+        for node_name, master in list(self.masters.items()):
+            if now - master["last_used"] > self.idle_timeout:
+                print(f"closing idle ssh master for {node_name}")
+                self.release(node_name)
+
+    def close_all(self):
+        """Close every master connection."""
+        for node_name in list(self.masters):
+            self.release(node_name)
+
+    def stats(self):
+        """Return pool counters for the dashboard."""
+        return {
+            "open_masters": len(self.masters),
+            "opened": self.opened,
+            "reuses": self.reuses,
+            "reconnects": self.reconnects,
+            "failures": self.failures,
+        }
+
+
+ssh_pool = SSHPool(pathlib.Path(tempfile.gettempdir()) / f"sc-ssh-{os.getuid()}")
+atexit.register(ssh_pool.close_all)
+transport = ssh_pool
+
+
 MEM_USED_WARN_PCT: float = 0.45
 CPU_LOAD_WARN_PCT: float = 0.5
 DISK_USED_WARN_PCT: float = 0.90
-ACKNOWLEDGED_ALERTS: set[str] = set()
+# disks only warn when they also have fewer than this many GB free
+DISK_AVAIL_WARN_GB = 10
+# a metric alert clears once its value is this far back under the threshold
+ALERT_HYSTERESIS = 0.05
+ALERT_KINDS = ["service", "down", "mem", "cpu", "disk"]
+
+
+class AlertKey(collections.namedtuple("AlertKey", ["kind", "node_name", "target"])):
+    """What an alert is about.
+
+    kind is one of ALERT_KINDS. target is the service name of service
+    alerts, the mount point of disk alerts and "" for the others.
+    """
+
+    __slots__ = ()
+
+    @property
+    def group(self):
+        """Return the warning count the alert is part of, nodes or services."""
+        return "services" if self.kind == "service" else "nodes"
+
+
+class Alerts:
+    """The active and acknowledged alerts, updated as metrics and states change.
+
+    Metric alerts are raised once their value has been over the threshold
+    for cfg_alert_for seconds and cleared once it is ALERT_HYSTERESIS back
+    under it, so values hovering around a threshold don't flap. Active
+    unacknowledged alerts are counted per node and group as they change,
+    so warning counts never need a pass over the fleet.
+    """
+
+    def __init__(self):
+        """Initialize class variables."""
+        self.lock = threading.Lock()
+        self.active = set()
+        self.acked = set()
+        # alert key -> time its value went over the threshold
+        self.pending = dict()
+        self.active_by_node = collections.defaultdict(set)
+        # active unacknowledged alerts by group and by (group, node name)
+        self.counts = collections.Counter()
+        # changes whenever an alert is acknowledged or unacknowledged
+        self.ack_version = 0
 
-services = None
-search_filter = None
+    def _count(self, key, n):
+        self.counts[key.group] += n
+        self.counts[key.group, key.node_name] += n
+
+    def _raise(self, key):
+        self.active.add(key)
+        self.active_by_node[key.node_name].add(key)
+        if key not in self.acked:
+            self._count(key, 1)
+
+    def _clear(self, key):
+        self.active.remove(key)
+        self.active_by_node[key.node_name].remove(key)
+        if key not in self.acked:
+            self._count(key, -1)
+
+    def update(self, key, over, under, for_s, now):
+        """Update an alert and return if it's active.
+
+        An inactive alert is raised once over has held for for_s seconds,
+        and an active one is cleared when under holds.
+        """
+        with self.lock:
+            if key in self.active:
+                if under:
+                    self._clear(key)
+            elif over:
+                since = self.pending.setdefault(key, now)
+                if now - since >= for_s:
+                    del self.pending[key]
+                    self._raise(key)
+            else:
+                self.pending.pop(key, None)
+            return key in self.active
+
+    def check(self, key, value, threshold, now):
+        """Update a metric alert from its value and return if it's active."""
+        return self.update(
+            key,
+            value > threshold,
+            value <= threshold - ALERT_HYSTERESIS,
+            cfg_alert_for,
+            now,
+        )
+
+    def set(self, key, firing):
+        """Raise or clear a state alert straight away and return if it's active."""
+        return self.update(key, firing, not firing, 0, 0)
+
+    def retain(self, node_name, kind, targets):
+        """Clear the node's alerts of a kind whose target is gone, e.g. a disk."""
+
+        def gone(key):
+            return (
+                key.node_name == node_name
+                and key.kind == kind
+                and key.target not in targets
+            )
+
+        with self.lock:
+            for key in [k for k in self.active_by_node[node_name] if gone(k)]:
+                self._clear(key)
+            for key in [k for k in self.pending if gone(k)]:
+                del self.pending[key]
+
+    def forget(self, node_names, pairs):
+        """Drop alerts of nodes and service/node pairs no longer configured.
+
+        Acknowledgements are kept, like they were before there was a config.
+        """
+        node_names = set(node_names)
+        pairs = set(pairs)
+
+        def gone(key):
+            if key.kind == "service":
+                return (key.target, key.node_name) not in pairs
+            return key.node_name not in node_names
+
+        with self.lock:
+            for key in [k for k in self.active if gone(k)]:
+                self._clear(key)
+            self.pending = {k: t for k, t in self.pending.items() if not gone(k)}
+            for node_name in set(self.active_by_node) - node_names:
+                del self.active_by_node[node_name]
+
+    def _ack(self, key, acked):
+        if (key in self.acked) == acked:
+            return
+        if acked:
+            self.acked.add(key)
+        else:
+            self.acked.remove(key)
+        if key in self.active:
+            self._count(key, -1 if acked else 1)
+        self.ack_version += 1
+
+    def toggle_ack(self, key):
+        """Acknowledge an alert, or unacknowledge it if it was.
+
+        Returns the acknowledged alerts as lists, for saving.
+        """
+        with self.lock:
+            self._ack(key, key not in self.acked)
+            return sorted(list(k) for k in self.acked)
+
+    def restore_acked(self, keys):
+        """Acknowledge alerts as returned by toggle_ack().
+
+        Acknowledgements saved as strings by older versions are skipped.
+        """
+        with self.lock:
+            for key in keys:
+                if isinstance(key, list) and len(key) == 3 and key[0] in ALERT_KINDS:
+                    self._ack(AlertKey(*key), True)
+
+    def restore(self, services, nodes):
+        """Raise the alerts shown in a restored snapshot."""
+        for node in nodes.nodes:
+            node_name = node.node_name
+            self.set(AlertKey("down", node_name, ""), not node.is_up)
+            self.set(AlertKey("mem", node_name, ""), bool(node.mem_warn))
+            self.set(AlertKey("cpu", node_name, ""), bool(node.cpu_warn))
+            for disk in node.df:
+                self.set(AlertKey("disk", node_name, disk["mounted_on"]), disk["warn"])
+        for service in services.all:
+            for node_name, status in service.status.items():
+                self.set(
+                    AlertKey("service", node_name, service.name), status != "active"
+                )
+
+    def is_acked(self, key):
+        """Return if the alert is acknowledged."""
+        return key in self.acked
+
+    def warnings(self, group, node_name=None):
+        """Return the number of active unacknowledged alerts in a group.
+
+        group is nodes or services; with node_name, only that node's are counted.
+        """
+        return self.counts[group if node_name is None else (group, node_name)]
+
+
+alerts = Alerts()
+
+snapshot = None
+poll_now = threading.Event()
+collection_cancelled = threading.Event()
+# how often the poller reloads the config and looks for nodes due a poll
+POLL_TICK = 2
+# nodes with warnings are polled this many times as often
+URGENT_POLL_FACTOR = 3
+# longest time between polls of a node that is down
+MAX_POLL_BACKOFF = 600
+cfg_poll_interval = 30
+cfg_parallelism = 16
+cfg_node_timeout = 10
+cfg_deploy_batch_size = 5
+cfg_deploy_timeout = 1800
+cfg_job_timeout = 60
+# seconds a metric has to stay over its threshold before it alerts
+cfg_alert_for = 0
+cfg_agent = False
+cfg_agent_interval = 10
 cfg_draw_tables = True
 cfg_draw_mermaid_diagram = True
 
 
+class NodeFacts:
+    """Facts about nodes that only change when they reboot, kept in a json file.
+
+    The facts are the boot id, number of cpus, total memory, kernel release
+    and the filesystems shown on the dashboard. They are collected again
+    only when the node's boot id changes, and the file is written at most
+    once per poll cycle.
+    """
+
+    def __init__(self):
+        """Initialize class variables."""
+        self.path = None
+        self.facts = dict()
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self, path):
+        """Read the facts saved in path, and save them there from now on."""
+        self.path = pathlib.Path(path)
+        if not self.path.exists():
+            return
+        try:
+            self.facts = json.loads(self.path.read_text())
+        except ValueError:
+            print(f"ignoring unreadable node facts in {path}")
+
+    def get(self, node_name):
+        """Return the node's facts, or an empty dict if there are none yet."""
+        return self.facts.get(node_name, {})
+
+    def set(self, node_name, facts):
+        """Replace the node's facts, to be written by the next save()."""
+        with self.lock:
+            self.facts[node_name] = facts
+            self.dirty = True
+
+    def forget(self, node_names):
+        """Drop the facts of nodes no longer configured."""
+        with self.lock:
+            for node_name in set(self.facts) - set(node_names):
+                del self.facts[node_name]
+                self.dirty = True
+
+    def save(self):
+        """Write all the facts to the file if they changed since the last save."""
+        with self.lock:
+            if not self.dirty or not self.path:
+                return
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            tmp_path.write_text(json.dumps(self.facts, indent=2))
+            tmp_path.replace(self.path)
+            self.dirty = False
+
+
+node_facts = NodeFacts()
+
+
 class Node:
     """Class encapsulating a worker node for purpose of collecting metrics."""
 
@@ -69,58 +829,117 @@ class Node:
         self.warnings = 0
         self.uptime = ""
         self.update_time_ms = 0
+        self.via_agent = False
+        self.kernel = ""
+
+    def metrics_script(self):
+        """Return the shell script that prints all node metrics as sections.
+
+        The node's facts are only printed if its boot id isn't the one they
+        were collected for, and df is only run on the known filesystems.
+        """
+        facts = node_facts.get(self.node_name)
+        script = (
+            section_script("boot_id", "cat /proc/sys/kernel/random/boot_id")
+            + section_script("meminfo", "grep ^MemAvailable: /proc/meminfo")
+            + section_script("loadavg", "cat /proc/loadavg")
+            + section_script("proc_uptime", "cat /proc/uptime")
+        )
+        mounts = [
+            shlex.quote(mounted_on) for _, mounted_on in facts.get("filesystems", [])
+        ]
+        if mounts:
+            script += section_script("df", "df -P -k " + " ".join(mounts))
+        boot_id = shlex.quote(facts.get("boot_id", ""))
+        script += (
+            f'if [ "$(cat /proc/sys/kernel/random/boot_id)" != {boot_id} ]; then\n'
+        )
+        script += (
+            section_script("cpus", "grep -c ^processor /proc/cpuinfo")
+            + section_script("mem_total", "grep ^MemTotal: /proc/meminfo")
+            + section_script("kernel", "uname -r")
+            + section_script("df_all", "df -P -k")
+        )
+        return script + "fi\n"
 
     def update_metrics(self):
-        """Update worker node metrics by running commands over ssh."""
-        time_now = datetime.datetime.now()
-        self.is_up = True
-        mem_cmd = ["ssh", "-oConnectTimeout=3", "root@" + self.node_name, "free"]
-        try:
-            mem_cmd_out_words = lines_words(subprocess.check_output(mem_cmd))
-        except subprocess.CalledProcessError:
-            self.is_up = False
-            self.warnings += 1
-            return
-        self.mem_used = int(int(mem_cmd_out_words[1][2]) // 1e3)
-        self.mem_avail = int(int(mem_cmd_out_words[1][1]) // 1e3)
-        load_cmd = ["ssh", "root@" + self.node_name, "uptime"]
-        load_cmd_out = subprocess.check_output(load_cmd)
-        uptime_end_idx = load_cmd_out.decode().index(",")
-        self.uptime = load_cmd_out.decode()[13:uptime_end_idx]
-        load_cmd_out_words = lines_words(load_cmd_out)
-        self.load = float(load_cmd_out_words[0][-3][:-1])
-        cpus_cmd = ["ssh", "root@" + self.node_name, "cat /proc/cpuinfo"]
-        cpus_cmd_out_words = subprocess.check_output(cpus_cmd).decode().split()
-        self.cpus = cpus_cmd_out_words.count("vendor_id")
-        df_cmd = ["ssh", "root@" + self.node_name, "df"]
-        df_out_words = lines_words(subprocess.check_output(df_cmd))[1:-1]
-        self.mem_warn = False
-        if int(self.mem_used) > MEM_USED_WARN_PCT * int(self.mem_avail):
-            self.mem_warn = True
-            if not is_node_alert_acked(self.node_name, "mem"):
-                self.warnings += 1
-        self.cpu_warn = False
-        if float(self.load) > CPU_LOAD_WARN_PCT * int(self.cpus):
-            self.cpu_warn = True
-            if not is_node_alert_acked(self.node_name, "cpu"):
-                self.warnings += 1
-        for df_data in df_out_words:
-            device = df_data[0]
-            mounted_on = " ".join(df_data[5:])
-            used_gb = int(df_data[2]) / 1000000
-            avail_gb = int(df_data[3]) / 1000000
+        """Update worker node metrics over a single ssh connection."""
+        collect_node(self, [])
+
+    def parse_metrics(self, sections):
+        """Set node metrics from the sections printed by metrics_script()."""
+        if "df_all" in sections:
+            self.parse_facts(sections)
+        facts = node_facts.get(self.node_name)
+        self.kernel = facts["kernel"]
+        mem_available_kb = int(sections["meminfo"].split()[1])
+        self.set_metrics(
+            {
+                "mem_used": (facts["mem_total_kb"] - mem_available_kb) // 1000,
+                "mem_avail": facts["mem_total_kb"] // 1000,
+                "uptime": format_uptime(float(sections["proc_uptime"].split()[0])),
+                "load": float(sections["loadavg"].split()[0]),
+                "cpus": facts["cpus"],
+                "df": parse_df(sections.get("df_all") or sections.get("df", "")),
+            }
+        )
+
+    def parse_facts(self, sections):
+        """Save the node facts printed by metrics_script() after a (re)boot."""
+        node_facts.set(
+            self.node_name,
+            {
+                "boot_id": sections["boot_id"].strip(),
+                "cpus": int(sections["cpus"].strip() or 0),
+                "mem_total_kb": int(sections["mem_total"].split()[1]),
+                "kernel": sections["kernel"].strip(),
+                "filesystems": [
+                    [device, mounted_on]
+                    for device, mounted_on, _, _ in parse_df(sections["df_all"])
+                    if is_reported_disk(device, mounted_on)
+                ],
+            },
+        )
+
+    def set_metrics(self, metrics):
+        """Set node metrics and warnings from a dict as sent by sc_agent.py.
+
+        df is a list of [device, mount point, used kB, available kB].
+        """
+        self.mem_used = metrics["mem_used"]
+        self.mem_avail = metrics["mem_avail"]
+        self.uptime = metrics["uptime"]
+        self.load = metrics["load"]
+        self.cpus = metrics["cpus"]
+        now = time.time()
+        mem_avail = int(self.mem_avail)
+        self.mem_warn = alerts.check(
+            AlertKey("mem", self.node_name, ""),
+            int(self.mem_used) / mem_avail if mem_avail else 0,
+            MEM_USED_WARN_PCT,
+            now,
+        )
+        cpus = int(self.cpus)
+        self.cpu_warn = alerts.check(
+            AlertKey("cpu", self.node_name, ""),
+            float(self.load) / cpus if cpus else 0,
+            CPU_LOAD_WARN_PCT,
+            now,
+        )
+        self.df = []
+        for device, mounted_on, used_kb, avail_kb in metrics["df"]:
+            if not is_reported_disk(device, mounted_on):
+                continue
+            used_gb = used_kb / 1000000
+            avail_gb = avail_kb / 1000000
             total_gb = used_gb + avail_gb
             percent_used = used_gb / total_gb
-            if not (
-                device.startswith("/dev/sd")
-                or device.startswith("/dev/mapper")
-                or device.startswith("/dev/vd")
-                or device.startswith("/dev/root")
-            ):
-                continue
-            if mounted_on == "/boot/efi":
-                continue
-            warn = percent_used > DISK_USED_WARN_PCT and avail_gb < 10
+            warn = alerts.check(
+                AlertKey("disk", self.node_name, mounted_on),
+                percent_used if avail_gb < DISK_AVAIL_WARN_GB else 0,
+                DISK_USED_WARN_PCT,
+                now,
+            )
             self.df.append(
                 {
                     "mounted_on": mounted_on,
@@ -130,20 +949,602 @@ class Node:
                     "warn": warn,
                 }
             )
-            if warn:
-                mounted_on_nice = mounted_on.replace("/", "-")
-                if not is_node_alert_acked(self.node_name, mounted_on_nice):
-                    self.warnings += 1
-        self.update_time_ms = (
-            datetime.datetime.now() - time_now
-        ).total_seconds() * 1000
+        alerts.retain(self.node_name, "disk", {disk["mounted_on"] for disk in self.df})
+
+
+def collect_node(node, services):
+    """Collect node metrics and the status of services on it with one ssh call.
+
+    The metrics commands and a single systemctl show for all the services
+    are sent as one script and the sectioned output is parsed locally.
+    """
+    time_now = datetime.datetime.now()
+    deadline = time.time() + cfg_node_timeout
+    node.is_up = True
+    node.via_agent = agents.apply(node, services)
+    if node.via_agent:
+        alerts.set(AlertKey("down", node.node_name, ""), False)
+        history.record_node(node)
+        history.record_services(node.node_name, services)
+        return
+    script = node.metrics_script()
+    if services:
+        script += services_status_script(services, uptime=False)
+    try:
+        with perf.timed("command", "collect", node=node.node_name):
+            out = transport.run_script(node.node_name, script, deadline)
+        sections = split_sections(out)
+    except TransportError:
+        sections = None
+    if sections is not None:
+        try:
+            with perf.timed("phase", "parse", node=node.node_name):
+                node.parse_metrics(sections)
+                set_services_state(node.node_name, services, sections)
+        except (IndexError, KeyError, ValueError) as e:
+            # e.g. a command that printed nothing, shown like a node that's down
+            print(f"{node.node_name}: couldn't parse collected output: {e!r}")
+            sections = None
+    node.is_up = sections is not None
+    alerts.set(AlertKey("down", node.node_name, ""), not node.is_up)
+    if not node.is_up:
+        for service in services:
+            service.set_status(node.node_name, "unknown")
+        history.record_services(node.node_name, services)
+        return
+    node.update_time_ms = (datetime.datetime.now() - time_now).total_seconds() * 1000
+    history.record_node(node)
+    history.record_services(node.node_name, services)
+
+
+def set_services_state(node_name, services, sections):
+    """Set the state of services on node from services_status_script() output."""
+    set_services_units(
+        node_name,
+        services,
+        parse_systemctl_show(sections.get("show", "")),
+        float((sections.get("proc_uptime", "").split() or [0])[0]),
+    )
+
+
+def set_services_units(node_name, services, units, uptime_s):
+    """Set the state of services on node from their systemctl show properties."""
+    for i, service in enumerate(services):
+        service.set_state(node_name, units[i] if i < len(units) else {}, uptime_s)
+
+
+AGENT_SCRIPT = pathlib.Path(__file__).parent / "sc_agent.py"
+# how long to wait before trying again on a node where the agent didn't run
+AGENT_RETRY_INTERVAL = 600
+
+
+class AgentStream:
+    """sc_agent.py running on a node, streaming samples over an ssh session."""
+
+    def __init__(self, node_name, units):
+        """Initialize class variables."""
+        self.node_name = node_name
+        self.units = units
+        self.proc = None
+        self.sample = None
+        self.show = ""
+        self.received = 0
+        self.samples = 0
+
+    def start(self):
+        """Start the agent, sending it to python3 on the node on stdin."""
+        args = [
+            "--interval",
+            str(cfg_agent_interval),
+            "--properties",
+            ",".join(SYSTEMCTL_SHOW_PROPERTIES),
+            *self.units,
+        ]
+        cmd = transport.argv(
+            self.node_name, "python3 -u - " + " ".join(map(shlex.quote, args))
+        )
+        self.proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.proc.stdin.write(AGENT_SCRIPT.read_bytes())
+        self.proc.stdin.close()
+        socketio.start_background_task(target=self.read_loop)
+
+    def read_loop(self):
+        """Keep the latest sample until the agent exits."""
+        for line in self.proc.stdout:
+            try:
+                sample = json.loads(line)
+            except ValueError:
+                continue
+            if "show" in sample:
+                self.show = sample["show"]
+            self.sample = sample
+            self.received = time.time()
+            self.samples += 1
+        self.proc.wait()
+        print(
+            f"agent on {self.node_name} exited with {self.proc.returncode} "
+            f"after {self.samples} samples"
+        )
+
+    def running(self):
+        """Return True if the agent process hasn't exited."""
+        return self.proc.poll() is None
+
+    def fresh(self):
+        """Return True if the latest sample is recent enough to use."""
+        return self.running() and time.time() - self.received < 3 * cfg_agent_interval
+
+    def stop(self):
+        """Stop the agent."""
+        if self.running():
+            self.proc.terminate()
+
+
+class Agents:
+    """sc agents streaming from nodes, used instead of polling them over ssh.
+
+    Nodes where the agent can't run (e.g. no python3) fall back to ssh
+    polling and the agent is tried again after AGENT_RETRY_INTERVAL.
+    """
+
+    def __init__(self):
+        """Initialize class variables."""
+        self.streams = dict()
+        self.failed = dict()
+
+    def sync(self, by_node):
+        """Run an agent for the services of every node in by_node, and no others."""
+        for node_name in set(self.streams) - set(by_node):
+            self.streams.pop(node_name).stop()
+        now = time.time()
+        for node_name, services in by_node.items():
+            units = [service.name for service in services]
+            stream = self.streams.get(node_name)
+            if stream and stream.running():
+                # keeps the master connection the agent's session runs on open
+                transport.acquire(node_name)
+                if stream.samples:
+                    self.failed.pop(node_name, None)
+                if stream.units == units:
+                    continue
+                stream.stop()
+            elif stream and not stream.samples:
+                self.failed[node_name] = now
+            if now - self.failed.get(node_name, 0) < AGENT_RETRY_INTERVAL:
+                self.streams.pop(node_name, None)
+                continue
+            if not transport.acquire(node_name):
+                continue
+            self.streams[node_name] = AgentStream(node_name, units)
+            self.streams[node_name].start()
+
+    def apply(self, node, services):
+        """Set node and service state from the node's agent; False if there's none."""
+        stream = self.streams.get(node.node_name)
+        if not stream or not stream.fresh():
+            return False
+        if services and stream.units != [service.name for service in services]:
+            return False
+        sample = stream.sample
+        node.set_metrics(sample)
+        set_services_units(
+            node.node_name,
+            services,
+            parse_systemctl_show(stream.show),
+            sample["uptime_s"],
+        )
+        node.update_time_ms = (time.time() - stream.received) * 1000
+        return True
+
+    def stop_all(self):
+        """Stop every agent."""
+        for stream in self.streams.values():
+            stream.stop()
+
+    def stats(self):
+        """Return agent counters for the dashboard."""
+        return {
+            "streaming": sum(stream.fresh() for stream in self.streams.values()),
+            "failed": len(self.failed),
+        }
+
+
+agents = Agents()
+atexit.register(agents.stop_all)
+
+
+class RingSeries:
+    """Ring buffers holding per-slot averages of some metrics at one resolution.
+
+    Slot i holds the samples whose time // resolution (the slot key) is
+    congruent to i modulo the number of slots. Each slot costs 6 bytes plus
+    4 bytes per metric, allocated up front.
+    """
+
+    def __init__(self, resolution, slots, metrics):
+        """Initialize class variables."""
+        self.resolution = resolution
+        self.slots = slots
+        self.keys = array.array("I", bytes(4 * slots))
+        self.counts = array.array("H", bytes(2 * slots))
+        self.values = {metric: array.array("f", bytes(4 * slots)) for metric in metrics}
+
+    def add(self, time_s, sample):
+        """Average a dict of metric values into the slot for time_s."""
+        key = int(time_s // self.resolution)
+        i = key % self.slots
+        if self.keys[i] != key:
+            self.keys[i] = key
+            self.counts[i] = 0
+        n = self.counts[i]
+        for metric, value in sample.items():
+            old = self.values[metric][i] if n else 0.0
+            self.values[metric][i] = old + (value - old) / (n + 1)
+        self.counts[i] = min(n + 1, 65535)
+        return i
+
+    def values_at(self, i):
+        """Return the slot's key, count and metric values."""
+        return (
+            self.keys[i],
+            self.counts[i],
+            {metric: values[i] for metric, values in self.values.items()},
+        )
+
+    def restore(self, key, count, values):
+        """Put a saved slot back, unless a newer sample took its place."""
+        i = key % self.slots
+        if self.keys[i] > key:
+            return
+        self.keys[i] = key
+        self.counts[i] = count
+        for metric, value in values.items():
+            if metric in self.values:
+                self.values[metric][i] = value
+
+    def covers(self, time_s):
+        """Return True if samples from time_s can still be in the buffer."""
+        return time.time() - time_s < self.resolution * self.slots
+
+    def query(self, metric, start, end):
+        """Return a list of [time, value] for metric between start and end."""
+        points = []
+        first_key = max(
+            int(start // self.resolution), int(end // self.resolution) - self.slots + 1
+        )
+        for key in range(first_key, int(end // self.resolution) + 1):
+            i = key % self.slots
+            if self.keys[i] == key and self.counts[i]:
+                points.append([key * self.resolution, round(self.values[metric][i], 3)])
+        return points
+
+
+HISTORY_TIERS = [(10, 360), (60, 1440), (600, 4320)]
+HISTORY_NODE_METRICS = ["mem_used_pct", "load", "disk_used_pct"]
+HISTORY_TRANSITIONS = 100
+
+
+class History:
+    """In-memory time series of node metrics and service state transitions.
+
+    Every node sample is averaged into each tier of ring buffers: 10 second
+    slots for an hour, 1 minute slots for a day and 10 minute slots for 30
+    days, which comes to about 110KB per node. Each service/node pair keeps
+    its last HISTORY_TRANSITIONS state changes.
+    """
+
+    def __init__(self, tiers=HISTORY_TIERS, metrics=HISTORY_NODE_METRICS):
+        """Initialize class variables."""
+        self.tiers = tiers
+        self.metrics = metrics
+        self.nodes = dict()
+        self.transitions = dict()
+        self.lock = threading.Lock()
+
+    def record_node(self, node, time_s=None):
+        """Add a sample of the node's current metrics."""
+        time_s = time_s or time.time()
+        sample = {
+            "mem_used_pct": (
+                100 * node.mem_used / node.mem_avail if node.mem_avail else 0
+            ),
+            "load": node.load,
+            "disk_used_pct": 100 * max([d["percent_used"] for d in node.df] or [0]),
+        }
+        with self.lock:
+            if node.node_name not in self.nodes:
+                self.nodes[node.node_name] = [
+                    RingSeries(resolution, slots, self.metrics)
+                    for resolution, slots in self.tiers
+                ]
+            slots = []
+            for series in self.nodes[node.node_name]:
+                i = series.add(time_s, sample)
+                slots.append((series.resolution, *series.values_at(i)))
+        state_store.save_slots(node.node_name, slots)
+
+    def record_services(self, node_name, services, time_s=None):
+        """Record the state of services on node if it changed."""
+        time_s = time_s or time.time()
+        with self.lock:
+            for service in services:
+                key = (service.name, node_name)
+                state = service.status.get(node_name)
+                if key not in self.transitions:
+                    self.transitions[key] = collections.deque(
+                        maxlen=HISTORY_TRANSITIONS
+                    )
+                transitions = self.transitions[key]
+                if not transitions or transitions[-1][1] != state:
+                    transitions.append((time_s, state))
+                    state_store.save_transition(service.name, node_name, time_s, state)
+
+    def restore_slot(self, node_name, resolution, key, count, values):
+        """Put back a saved slot of a node's history."""
+        with self.lock:
+            if node_name not in self.nodes:
+                self.nodes[node_name] = [
+                    RingSeries(resolution, slots, self.metrics)
+                    for resolution, slots in self.tiers
+                ]
+            for series in self.nodes[node_name]:
+                if series.resolution == resolution:
+                    series.restore(key, count, values)
+
+    def restore_transition(self, service_name, node_name, time_s, state):
+        """Put back a saved state change of a service on a node."""
+        with self.lock:
+            key = (service_name, node_name)
+            if key not in self.transitions:
+                self.transitions[key] = collections.deque(maxlen=HISTORY_TRANSITIONS)
+            self.transitions[key].append((time_s, state))
+
+    def node_metric(self, node_name, metric, start, end):
+        """Return (resolution, points) from the finest tier that reaches back to start."""
+        with self.lock:
+            tiers = self.nodes.get(node_name)
+            if not tiers:
+                return None, []
+            series = next((t for t in tiers if t.covers(start)), tiers[-1])
+            return series.resolution, series.query(metric, start, end)
+
+    def service_transitions(self, service_name, node_name, start, end):
+        """Return the state changes of a service on a node between start and end."""
+        with self.lock:
+            transitions = self.transitions.get((service_name, node_name), [])
+            return [[t, state] for t, state in transitions if start <= t <= end]
+
+    def forget(self, node_names, pairs):
+        """Drop history for nodes and service/node pairs no longer configured."""
+        with self.lock:
+            for node_name in set(self.nodes) - set(node_names):
+                del self.nodes[node_name]
+            for pair in set(self.transitions) - set(pairs):
+                del self.transitions[pair]
+
+
+history = History()
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS node_history (
+    node TEXT, resolution INTEGER, key INTEGER, count INTEGER, metrics TEXT,
+    PRIMARY KEY (node, resolution, key)
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    service TEXT, node TEXT, time REAL, state TEXT
+);
+CREATE INDEX IF NOT EXISTS transitions_time ON transitions (time);
+"""
+# how long writes wait in memory to be committed together
+STATE_WRITE_INTERVAL = 1
+STATE_PRUNE_INTERVAL = 3600
+
+
+class StateStore:
+    """SQLite database of what sc needs to start warm after a restart.
+
+    It holds the last published snapshot, the acknowledged alerts and the
+    node and service history. Writes are queued and committed together by
+    a background thread every STATE_WRITE_INTERVAL, so polls and requests
+    never wait on the disk.
+    Of the snapshots published in that time only the last one is written,
+    and history is written as the ring buffer slots that changed. The
+    database is in WAL mode, so a crash loses at most the last batch.
+    """
+
+    def __init__(self):
+        """Initialize class variables."""
+        self.db = None
+        self.writes = queue.Queue()
+        self.lock = threading.Lock()
+        self.last_prune = 0
+        self.stopping = threading.Event()
+        self.writer_thread = None
+
+    def open(self, path):
+        """Open (or create) the database at path and start writing to it."""
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(STATE_SCHEMA)
+        # a daemon, so that it doesn't hold up exit; close() commits the rest
+        self.writer_thread = threading.Thread(target=self.writer, daemon=True)
+        self.writer_thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        """Commit the queued writes and stop the writer, e.g. at exit."""
+        if not self.writer_thread:
+            return
+        self.stopping.set()
+        # wakes the writer if it's waiting for a write
+        self.writes.put(None)
+        self.writer_thread.join()
+        self.writer_thread = None
+
+    def get(self, key, default=None):
+        """Return a saved value, or default."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM kv WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def save(self, key, value):
+        """Queue a json serializable value to be saved under key."""
+        if self.db:
+            self.writes.put(("kv", key, value))
+
+    def save_snapshot(self, snap):
+        """Queue a published snapshot to be saved."""
+        if self.db:
+            self.writes.put(("snapshot", snap))
+
+    def save_slots(self, node_name, slots):
+        """Queue changed history slots of a node to be saved."""
+        if self.db:
+            self.writes.put(("slots", node_name, slots))
+
+    def save_transition(self, service_name, node_name, time_s, state):
+        """Queue a service state change to be saved."""
+        if self.db:
+            self.writes.put(("transition", service_name, node_name, time_s, state))
+
+    def writer(self):
+        """Background loop committing queued writes in batches until close()."""
+        while not self.stopping.is_set():
+            first = self.writes.get()
+            self.stopping.wait(STATE_WRITE_INTERVAL)
+            try:
+                self.flush([first])
+                if time.time() - self.last_prune > STATE_PRUNE_INTERVAL:
+                    self.prune()
+            except sqlite3.Error as e:
+                print(f"saving state failed: {e}")
+
+    def flush(self, writes=None):
+        """Commit the queued writes in one transaction."""
+        writes = writes or []
+        while True:
+            try:
+                writes.append(self.writes.get_nowait())
+            except queue.Empty:
+                break
+        # None is close()'s wakeup
+        writes = [write for write in writes if write is not None]
+        if not writes:
+            return
+        kv = dict()
+        slots = dict()
+        transitions = []
+        for write in writes:
+            if write[0] == "kv":
+                kv[write[1]] = write[2]
+            elif write[0] == "snapshot":
+                kv["snapshot"] = write[1]
+            elif write[0] == "slots":
+                for resolution, key, count, values in write[2]:
+                    slots[(write[1], resolution, key)] = (count, values)
+            elif write[0] == "transition":
+                transitions.append(write[1:])
+        snap = kv.get("snapshot")
+        if snap:
+            kv["snapshot"] = {
+                "version": snap.version,
+                "created": snap.created,
+                "data": snap.data,
+            }
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO kv VALUES (?, ?)",
+                [(key, json.dumps(value, default=str)) for key, value in kv.items()],
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO node_history VALUES (?, ?, ?, ?, ?)",
+                [
+                    (*slot, count, json.dumps(values))
+                    for slot, (count, values) in slots.items()
+                ],
+            )
+            self.db.executemany(
+                "INSERT INTO transitions VALUES (?, ?, ?, ?)", transitions
+            )
+
+    def prune(self):
+        """Delete history older than the ring buffers and transitions keep."""
+        self.last_prune = time.time()
+        with self.lock, self.db:
+            for resolution, slots in HISTORY_TIERS:
+                self.db.execute(
+                    "DELETE FROM node_history WHERE resolution = ? AND key <= ?",
+                    (resolution, self.last_prune // resolution - slots),
+                )
+            # older state changes than the longest history are never shown
+            longest = max(resolution * slots for resolution, slots in HISTORY_TIERS)
+            self.db.execute(
+                "DELETE FROM transitions WHERE time < ?", (self.last_prune - longest,)
+            )
+
+    def restore_history(self, history, node_names, pairs):
+        """Load the saved history of configured nodes and service/node pairs."""
+        with self.lock:
+            slots = self.db.execute("SELECT * FROM node_history").fetchall()
+            transitions = self.db.execute(
+                "SELECT * FROM transitions ORDER BY time"
+            ).fetchall()
+        for node_name, resolution, key, count, values in slots:
+            if node_name in node_names:
+                history.restore_slot(
+                    node_name, resolution, key, count, json.loads(values)
+                )
+        for service_name, node_name, time_s, state in transitions:
+            if (service_name, node_name) in pairs:
+                history.restore_transition(service_name, node_name, time_s, state)
+
+    def restore_snapshot(self, services, nodes):
+        """Return the saved snapshot rebuilt on the current config, or None.
+
+        The saved state of nodes and services that are still configured is
+        put back on the live ones, which the next polls then update. The
+        returned snapshot is marked stale.
+        """
+        saved = self.get("snapshot")
+        if not saved:
+            return None
+        for node in nodes.nodes:
+            node.__dict__.update(saved["data"]["nodes"].get(node.node_name, {}))
+        for service in services.all:
+            state = saved["data"]["services"].get(service.name, {})
+            for attr in SERVICE_STATE_ATTRS:
+                getattr(service, attr).update(
+                    {n: v for n, v in state.get(attr, {}).items() if n in service.nodes}
+                )
+        alerts.restore(services, nodes)
+        nodes.update_totals()
+        services.update_warnings()
+        snap = make_snapshot(saved["version"], services, nodes, 0)
+        snap.created = saved["created"]
+        snap.stale = True
+        return snap
+
+
+state_store = StateStore()
 
 
 class Nodes:
     """Class for storing a collection of worker nodes."""
 
-    def __init__(self, node_names):
-        """Initialize class variables."""
+    def __init__(self, node_names, old=None):
+        """Initialize class variables.
+
+        Nodes that are also in old are reused along with their collected metrics.
+        """
         self.nodes = []
         self.warnings = 0
         self.total_mem_used = 0
@@ -152,15 +1553,38 @@ class Nodes:
         self.total_cpus = 0
         self.total_df_used_gb = 0
         self.total_df_total_gb = 0
+        old_nodes = {node.node_name: node for node in old.nodes} if old else {}
         for node_name in node_names:
-            self.nodes.append(Node(node_name))
+            self.nodes.append(old_nodes.get(node_name) or Node(node_name))
+
+    def update_tasks(self, services=None):
+        """Return the collection tasks for all nodes, for use with fan_out.
+
+        If services are given, their status is collected in the same ssh call.
+        """
+        if services is None:
+            return [node.update_metrics for node in self.nodes]
+        return [
+            functools.partial(collect_node, node, services.by_node[node.node_name])
+            for node in self.nodes
+        ]
 
     def update(self):
-        """Update metrics on all nodes."""
-        self.warnings = 0
+        """Update metrics on all nodes concurrently."""
+        fan_out(self.update_tasks())
+        self.update_totals()
+
+    def update_totals(self):
+        """Sum up warnings and usage over all nodes."""
+        self.warnings = alerts.warnings("nodes")
+        self.total_mem_used = 0
+        self.total_mem_avail = 0
+        self.total_load = 0
+        self.total_cpus = 0
+        self.total_df_used_gb = 0
+        self.total_df_total_gb = 0
         for node in self.nodes:
-            node.update_metrics()
-            self.warnings += node.warnings
+            node.warnings = alerts.warnings("nodes", node.node_name)
             self.total_mem_used += node.mem_used
             self.total_mem_avail += node.mem_avail
             self.total_load += node.load
@@ -169,11 +1593,58 @@ class Nodes:
             self.total_df_total_gb += sum([disk["total_gb"] for disk in node.df])
 
 
+SYSTEMD_UNIT_DIR = "/lib/systemd/system"
+# defines sc_put PATH SHA256, which writes base64 from stdin to PATH unless
+# PATH already has that hash, and fails if it didn't write it
+REMOTE_PUT_FUNCTION = """sc_put() {
+  if [ "$(sha256sum "$1" 2>/dev/null | cut -d ' ' -f 1)" = "$2" ]; then
+    cat > /dev/null
+    echo "$1 is up to date"
+    return 1
+  fi
+  # a file that can't be written ends the whole session
+  base64 -d > "$1.sc-new" && mv "$1.sc-new" "$1" || exit $?
+}
+"""
+
+
+def remote_put(path, content):
+    """Return a remote sc_put command that writes content to path unless it's there.
+
+    The content is compared by its sha256 on the node, so an unchanged file
+    isn't written again. It's sent as base64 in a here document. sc_put
+    returns 1 if the file was already up to date, and exits the session if
+    the file couldn't be written.
+    """
+    digest = hashlib.sha256(content.encode()).hexdigest()
+    data = base64.encodebytes(content.encode()).decode()
+    return f"sc_put {shlex.quote(path)} {digest} <<'SC_EOF'\n{data}SC_EOF\n"
+
+
+def remote_session(node_name, lines):
+    """Return a local script that runs remote lines on node in one ssh session."""
+    ssh = transport.script_prefix(node_name, "ssh")
+    body = "set -x\n" + REMOTE_PUT_FUNCTION + lines
+    return f"set -x\n\n{ssh} root@{node_name} bash -s <<'SC_SESSION_EOF'\n{body}SC_SESSION_EOF\n"
+
+
+# the per node state of a service that is collected rather than configured
+SERVICE_STATE_ATTRS = [
+    "status",
+    "last_changed",
+    "sub_state",
+    "main_pid",
+    "memory_mb",
+    "cpu_seconds",
+]
+
+
 class Service:
     """Class encapsulating a service (across all worker nodes)."""
 
     def __init__(self, service_dict):
         """Initialize class variables."""
+        self.service_dict = service_dict
         self.name = service_dict["name"]
         self.nodes = service_dict.get("nodes", [])
         self.deploy_script = service_dict.get("deploy", None)
@@ -181,122 +1652,181 @@ class Service:
         self.systemd_unit = service_dict.get("unit", None)
         self.svc_uris = service_dict.get("svc_uris", [])
         self.doc_sites = service_dict.get("doc_sites", [])
+        self.tags = service_dict.get("tags", [])
         self.status = dict()
         self.last_changed = dict()
+        self.sub_state = dict()
+        self.main_pid = dict()
+        self.memory_mb = dict()
+        self.cpu_seconds = dict()
+
+    def copy_state_from(self, other):
+        """Copy collected state for nodes this service is still on from other."""
+        for attr in SERVICE_STATE_ATTRS:
+            old_state = getattr(other, attr)
+            getattr(self, attr).update(
+                {n: old_state[n] for n in self.nodes if n in old_state}
+            )
 
     def update_status_on_node(self, node_name):
-        """Update the service status on a node by running systemctl status."""
-        cmd = [
-            "ssh",
-            "root@" + node_name,
-            "systemctl",
-            "--no-page",
-            "status",
-            self.name,
-        ]
-        p = subprocess.run(cmd, stdout=subprocess.PIPE)
+        """Update the service status on a node by running systemctl show."""
+        deadline = time.time() + cfg_node_timeout
         try:
-            ws = p.stdout.decode().split("\n")
-            semi_col_idx = ws[2].index(";")
-            self.last_changed[node_name] = ws[2][semi_col_idx + 2 :]
-        except Exception:
-            print(f"couldn't parse last_changed: {ws}")
-
-        if p.returncode == 0:
-            self.status[node_name] = "active"
-        elif p.returncode == 3:
-            self.status[node_name] = "inactive"
+            with perf.timed("command", "status", node=node_name, service=self.name):
+                out = transport.run_script(
+                    node_name, services_status_script([self]), deadline
+                )
+        except TransportError:
+            self.set_status(node_name, "unknown")
+            return
+        set_services_state(node_name, [self], split_sections(out))
+
+    def set_status(self, node_name, status):
+        """Set the status on a node, raising or clearing its alert."""
+        self.status[node_name] = status
+        alerts.set(AlertKey("service", node_name, self.name), status != "active")
+
+    def set_state(self, node_name, props, uptime_s):
+        """Set the state on a node from systemctl show properties."""
+        active_state = props.get("ActiveState")
+        if not active_state or props.get("LoadState") == "not-found":
+            self.set_status(node_name, "unknown")
+        elif active_state in ["active", "reloading"]:
+            self.set_status(node_name, "active")
         else:
-            self.status[node_name] = "unknown"
+            self.set_status(node_name, "inactive")
+        self.sub_state[node_name] = props.get("SubState", "")
+        self.main_pid[node_name] = int(props.get("MainPID") or 0)
+        changed_us = parse_counter(props.get("StateChangeTimestampMonotonic"))
+        if changed_us and uptime_s:
+            self.last_changed[node_name] = format_ago(uptime_s - changed_us / 1e6)
+        memory = parse_counter(props.get("MemoryCurrent"))
+        self.memory_mb[node_name] = None if memory is None else memory // 1000000
+        cpu = parse_counter(props.get("CPUUsageNSec"))
+        self.cpu_seconds[node_name] = None if cpu is None else cpu / 1e9
+
+    def update_tasks(self):
+        """Return the status tasks for all nodes, for use with fan_out."""
+        return [
+            functools.partial(self.update_status_on_node, node_name)
+            for node_name in self.nodes
+        ]
 
     def update_status_on_all_nodes(self):
-        """Update service status on all nodes."""
-        for node_name in self.nodes:
-            self.update_status_on_node(node_name)
+        """Update service status on all nodes concurrently."""
+        fan_out(self.update_tasks())
 
-    def start(self, node_name):
-        """Start service on node by running systemctl start."""
-        cmd = ["ssh", "root@" + node_name, "systemctl", "start", self.name]
-        subprocess.run(cmd)
+    def systemctl(self, action, node_name, deadline):
+        """Run systemctl start, stop or restart for the service on node."""
+        with perf.timed("command", f"systemctl {action}", node_name, self.name):
+            transport.run(node_name, "systemctl", action, self.name, deadline=deadline)
 
-    def stop(self, node_name):
-        """Stop service on node by running systemctl stop."""
-        cmd = ["ssh", "root@" + node_name, "systemctl", "stop", self.name]
-        subprocess.run(cmd)
+    def unit_path(self):
+        """Return the path of the service's unit file on nodes."""
+        return f"{SYSTEMD_UNIT_DIR}/{self.name}.service"
 
-    def restart(self, node_name):
-        """Restart service on node by running systemctl restart."""
-        cmd = ["ssh", "root@" + node_name, "systemctl", "restart", self.name]
-        subprocess.run(cmd)
+    def put_script(self, action, script):
+        """Return remote lines that put a deploy or delete script on the node and run it."""
+        content = "set -x\n\n" + script
+        digest = hashlib.sha256(content.encode()).hexdigest()
+        path = f"/tmp/sc.{self.name}.{action}.{digest[:12]}.sh"
+        # the script mustn't read the rest of the session from stdin
+        return remote_put(path, content) + f"bash {path} < /dev/null || exit $?\n"
 
-    def deploy(self, node_name):
-        """Return deploy script for service on node."""
-        script = "set -x\n\n"
+    def deploy_lines(self):
+        """Return the remote lines that install the unit and run the deploy script."""
+        lines = ""
+        if self.systemd_unit:
+            lines += f"if {remote_put(self.unit_path(), self.systemd_unit)}"
+            lines += "then systemctl daemon-reload || exit $?\nfi\n"
+        lines += self.put_script("deploy", self.deploy_script)
         if self.systemd_unit:
-            with open(f"/tmp/{self.name}.service", "w") as f:
-                f.write(self.systemd_unit)
-            script += f"scp /tmp/{self.name}.service root@{node_name}:/lib/systemd/system/{self.name}.service\n"
-            script += f"ssh root@{node_name} systemctl daemon-reload\n"
-        with open(f"/tmp/{self.name}.deploy.sh", "w") as f:
-            f.write("set -x\n\n")
-            f.write(self.deploy_script)
-        script += f"scp /tmp/{self.name}.deploy.sh root@{node_name}:/tmp/sc.{self.name}.deploy.sh\n"
-        script += f"ssh root@{node_name} bash /tmp/sc.{self.name}.deploy.sh\n"
+            lines += f"systemctl start {self.name}.service || exit $?\n"
+        return lines
+
+    def delete_lines(self, keep_unit=False):
+        """Return the remote lines that stop the service and run the delete script."""
+        lines = ""
         if self.systemd_unit:
-            script += f"ssh root@{node_name} systemctl start {self.name}.service\n"
-        return script
+            lines += f"systemctl stop {self.name}.service || exit $?\n"
+            if not keep_unit:
+                lines += f"rm {self.unit_path()} || exit $?\n"
+                lines += "systemctl daemon-reload || exit $?\n"
+        return lines + self.put_script("delete", self.delete_script)
+
+    def deploy(self, node_name):
+        """Return deploy script for service on node."""
+        return remote_session(node_name, self.deploy_lines())
 
     def delete(self, node_name):
         """Return delete deployment script for service on node."""
-        script = "set -x\n\n"
-        if self.systemd_unit:
-            script += f"ssh root@{node_name} systemctl stop {self.name}.service\n"
-            script += (
-                f"ssh root@{node_name} rm /lib/systemd/system/{self.name}.service\n"
-            )
-            script += f"ssh root@{node_name} systemctl daemon-reload\n"
-        with open(f"/tmp/{self.name}.delete.sh", "w") as f:
-            f.write("set -x\n\n")
-            f.write(self.delete_script)
-        script += f"scp /tmp/{self.name}.delete.sh root@{node_name}:/tmp/sc.{self.name}.delete.sh\n"
-        script += f"ssh root@{node_name} bash /tmp/sc.{self.name}.delete.sh\n"
-        return script
+        return remote_session(node_name, self.delete_lines())
 
     def update(self, node_name):
-        """Return update script for service on node by running delete and then deploy."""
-        script = self.delete(node_name)
-        script += self.deploy(node_name)
-        return script
+        """Return update script for service on node by running delete and then deploy.
+
+        The unit file is left in place between the two, so that it is only
+        replaced (and systemd reloaded) if it changed.
+        """
+        return remote_session(
+            node_name, self.delete_lines(keep_unit=True) + self.deploy_lines()
+        )
 
 
 class Services:
     """Class encapsulating a collection of services."""
 
-    def __init__(self, conf_str):
+    def __init__(self, conf_str, old=None):
         """Initialize class variables."""
         self.config = yaml.safe_load(conf_str)
         self.all = []
         self.by_name = dict()
         self.by_node = collections.defaultdict(list)
         self.warnings = 0
-        self._config_changed()
+        self.new_pairs = set()
+        self._config_changed(old)
+        self.mermaid_diagram = None
+        if self.config.get("mermaid_diagram"):
+            self.mermaid_diagram = MermaidDiagram(
+                self.config["mermaid_diagram"], self.by_name, self.by_node
+            )
+
+    def _config_changed(self, old=None):
+        """Update class variables to be done when the config changes.
 
-    def _config_changed(self):
-        """Update class variables to be done when the config changes."""
+        Services whose definition is the same as in old are reused with their
+        state. Pairs of (service name, node name) without any state yet are
+        put in new_pairs.
+        """
         for service_dict in self.config.get("services", []):
             service = Service(service_dict)
+            old_service = old.by_name.get(service.name) if old else None
+            if old_service and old_service.service_dict == service_dict:
+                service = old_service
+            elif old_service:
+                service.copy_state_from(old_service)
+            for node_name in service.nodes:
+                if node_name not in service.status:
+                    self.new_pairs.add((service.name, node_name))
             self.all.append(service)
             self.by_name[service.name] = service
             for node_name in service.nodes:
                 self.by_node[node_name].append(service)
 
+    def update_tasks(self):
+        """Return the status tasks for every service on every node."""
+        return [task for service in self.all for task in service.update_tasks()]
+
     def update_service_status(self):
-        """Update services status on all nodes."""
-        self.warnings = 0
+        """Update services status on all nodes concurrently."""
+        fan_out(self.update_tasks())
+        self.update_warnings()
+
+    def update_warnings(self):
+        """Count unacknowledged service warnings and print a status table."""
+        self.warnings = alerts.warnings("services")
         out = []
         for service in self.all:
-            print(f"updating {service.name}")
-            service.update_status_on_all_nodes()
             for node_name, status in service.status.items():
                 out.append(
                     [
@@ -306,9 +1836,6 @@ class Services:
                         service.last_changed.get(node_name),
                     ]
                 )
-                if status != "active":
-                    if not is_service_alert_acked(service.name, node_name):
-                        self.warnings += 1
         print()
         print(
             tabulate.tabulate(
@@ -327,49 +1854,1064 @@ def icon(name):
     return f'<i class="fa fa-{name} fa-fw"></i>'
 
 
-@app.context_processor
-def inject_globals():
-    """Add some stuff into all templates."""
-    return {
+def sparkline(node_name, metric, seconds=3600, width=80, height=14):
+    """Format an inline svg sparkline of a node metric over the last seconds."""
+    end = time.time()
+    _, points = history.node_metric(node_name, metric, end - seconds, end)
+    if len(points) < 2:
+        return ""
+    values = [value for _, value in points]
+    top = max(max(values), 1e-9)
+    coords = " ".join(
+        f"{width * (t - end + seconds) / seconds:.1f},{height - height * v / top:.1f}"
+        for t, v in points
+    )
+    return (
+        f'<svg width="{width}" height="{height}" style="vertical-align: middle">'
+        f"<title>{metric} over the last {seconds // 60} minutes, max {top:.1f}</title>"
+        f'<polyline fill="none" stroke="#3f51b5" points="{coords}"/></svg>'
+    )
+
+
+def cell_id(*parts):
+    """Return the html id of a dashboard cell that live updates can patch."""
+    return "c" + hashlib.sha1("\0".join(parts).encode()).hexdigest()[:12]
+
+
+# globals rather than a context processor so that imported macros see them too
+app.jinja_env.globals.update(
+    {
         "icon": icon,
+        "sparkline": sparkline,
+        "cell_id": cell_id,
     }
+)
 
 
-def make_service_node_dict():
-    """Make a dict[dict] to be used by the dashboard."""
-    out = collections.defaultdict(dict)
-    for service in services.all:
-        for node_name in service.nodes:
-            out[service.name][node_name] = service
+class SearchIndex:
+    """Index of a snapshot's service/node pairs for the dashboard search.
+
+    Built once per snapshot. Service and node names are kept sorted, so
+    prefix queries are a binary search, and pairs are grouped by service,
+    node, status and tag, so that queries combine sets instead of looking
+    at every pair.
+    """
+
+    def __init__(self, services, nodes):
+        """Initialize class variables."""
+        self.pairs = [(s.name, n) for s in services.all for n in s.nodes]
+        self.by_service = collections.defaultdict(set)
+        self.by_node = collections.defaultdict(set)
+        self.by_status = collections.defaultdict(set)
+        self.by_sub_state = collections.defaultdict(set)
+        self.by_tag = collections.defaultdict(set)
+        for service in services.all:
+            for node_name in service.nodes:
+                pair = (service.name, node_name)
+                self.by_service[service.name.lower()].add(pair)
+                self.by_node[node_name.lower()].add(pair)
+                status = service.status.get(node_name) or "unknown"
+                self.by_status[status.lower()].add(pair)
+                # systemd's sub state too, e.g. failed services are inactive/failed
+                sub_state = service.sub_state.get(node_name)
+                if sub_state:
+                    self.by_sub_state[sub_state.lower()].add(pair)
+                for tag in service.tags:
+                    self.by_tag[str(tag).lower()].add(pair)
+        self.service_names = sorted(self.by_service)
+        self.node_names = sorted(self.by_node)
+        down_nodes = {node.node_name for node in nodes.nodes if not node.is_up}
+        warn_nodes = {node.node_name for node in nodes.nodes if node.warnings}
+        self.down = {pair for pair in self.pairs if pair[1] in down_nodes}
+        self.node_warnings = {pair for pair in self.pairs if pair[1] in warn_nodes}
+
+    @staticmethod
+    def match_names(names, term):
+        """Return the sorted names that contain term, or start with it if it ends in *."""
+        if term.endswith("*"):
+            prefix = term[:-1]
+            i = bisect.bisect_left(names, prefix)
+            j = bisect.bisect_left(names, prefix + "\U0010ffff")
+            return names[i:j]
+        return [name for name in names if term in name]
+
+    def pairs_named(self, names, by_name):
+        """Return the pairs of the services or nodes in names."""
+        return set().union(*(by_name[name] for name in names))
+
+    def warnings(self):
+        """Return the pairs with an unacknowledged service or node warning."""
+        return self.node_warnings | {
+            pair
+            for status, pairs in self.by_status.items()
+            if status != "active"
+            for pair in pairs
+            if not alerts.is_acked(AlertKey("service", pair[1], pair[0]))
+        }
+
+    def term_pairs(self, term):
+        """Return the pairs that match one search term."""
+        field, _, value = term.partition(":")
+        if field == "status":
+            return self.by_status.get(value, set()) | self.by_sub_state.get(
+                value, set()
+            )
+        if field == "tag":
+            return self.by_tag.get(value, set())
+        if field == "service":
+            return self.pairs_named(
+                self.match_names(self.service_names, value), self.by_service
+            )
+        if field == "node":
+            return self.pairs_named(
+                self.match_names(self.node_names, value), self.by_node
+            )
+        if term == "is:down":
+            return self.down
+        if term == "is:warn":
+            return self.warnings()
+        return self.pairs_named(
+            self.match_names(self.service_names, term), self.by_service
+        ) | self.pairs_named(self.match_names(self.node_names, term), self.by_node)
+
+    def query(self, text):
+        """Return the pairs matching every term of a search, in config order."""
+        matches = None
+        for term in text.lower().split():
+            pairs = self.term_pairs(term)
+            matches = pairs if matches is None else matches & pairs
+        if matches is None:
+            return list(self.pairs)
+        return [pair for pair in self.pairs if pair in matches]
+
+
+class Snapshot:
+    """Immutable, versioned view of the fleet produced by one poll cycle.
+
+    A snapshot is never modified after it is published, so request handlers
+    can read it without locking while the poller builds the next one.
+    """
+
+    def __init__(self, version, config, services, nodes, mermaid_diagram, poll_ms):
+        """Initialize class variables."""
+        self.version = version
+        self.created = time.time()
+        self.config = config
+        self.services = services
+        self.nodes = nodes
+        self.mermaid_diagram = mermaid_diagram
+        self.poll_ms = poll_ms
+        # true for the snapshot restored from the state store at startup
+        self.stale = False
+
+    def age(self):
+        """Return the number of seconds since the snapshot was collected."""
+        return time.time() - self.created
+
+    @functools.cached_property
+    def search_index(self):
+        """Return the search index of the snapshot's service/node pairs."""
+        return SearchIndex(self.services, self.nodes)
+
+    @functools.cached_property
+    def data(self):
+        """Return the snapshot as plain data, with nodes and services keyed by name."""
+        return {
+            "nodes": {node.node_name: dict(node.__dict__) for node in self.nodes.nodes},
+            "services": {
+                service.name: {
+                    k: v for k, v in service.__dict__.items() if k != "service_dict"
+                }
+                for service in self.services.all
+            },
+        }
+
+
+SEARCH_SORTS = {
+    "": "config order",
+    "name": "name",
+    "status": "problems first",
+}
+DASHBOARD_PAGE_SIZE = 50
+
+
+@functools.lru_cache(maxsize=64)
+def search_snapshot(version, query, sort, page, page_size, ack_version):
+    """Return the page of a snapshot's services and nodes that match a search.
+
+    The result has the matching services, each with its matching node names,
+    and the nodes of those pairs, each sorted by sort and cut to page_size.
+    Cached per snapshot version, search and alerts.ack_version.
+    """
+    snap = find_snapshot(version)
+    pairs = snap.search_index.query(query)
+    by_service = dict()
+    node_names = dict()
+    for service_name, node_name in pairs:
+        by_service.setdefault(service_name, []).append(node_name)
+        node_names[node_name] = None
+    services = [
+        (snap.services.by_name[name], names) for name, names in by_service.items()
+    ]
+    nodes = [node for node in snap.nodes.nodes if node.node_name in node_names]
+    if sort == "name":
+        services.sort(key=lambda x: x[0].name)
+        for _, names in services:
+            names.sort()
+        nodes.sort(key=lambda node: node.node_name)
+    elif sort == "status":
+        services.sort(key=lambda x: -sum(x[0].status.get(n) != "active" for n in x[1]))
+        nodes.sort(key=lambda node: (node.is_up, -node.warnings))
+    pages = max(math.ceil(max(len(services), len(nodes)) / page_size), 1)
+    page = min(max(page, 1), pages)
+    start = (page - 1) * page_size
+    return {
+        "services": services[start : start + page_size],
+        "nodes": nodes[start : start + page_size],
+        "matches": len(pairs),
+        "page": page,
+        "pages": pages,
+    }
+
+
+# published snapshots are kept for deltas for this many poll intervals,
+# so a client that asks once per interval finds the one it last saw, but
+# never more than SNAPSHOT_HISTORY_MAX of them as each is a full copy
+SNAPSHOT_HISTORY_POLLS = 3
+SNAPSHOT_HISTORY_MAX = 100
+recent_snapshots = collections.deque(maxlen=SNAPSHOT_HISTORY_MAX)
+
+
+def remember_snapshot(snap):
+    """Keep a published snapshot and forget those past the history window."""
+    recent_snapshots.append(snap)
+    oldest = snap.created - SNAPSHOT_HISTORY_POLLS * cfg_poll_interval
+    while recent_snapshots[0].created < oldest:
+        recent_snapshots.popleft()
+
+
+def find_snapshot(version):
+    """Return a recently published snapshot by version, or None."""
+    for snap in recent_snapshots:
+        if snap.version == version:
+            return snap
+    return None
+
+
+def filter_snapshot_data(data, fields, node_names, service_names, pairs=None):
+    """Return the snapshot data restricted to some fields, nodes and services.
+
+    Per-node service state (status, last_changed, ...) is restricted to the
+    selected nodes as well. If pairs is given, only those service/node pairs
+    and their nodes are included.
+    """
+    matched = None
+    if pairs is not None:
+        matched = collections.defaultdict(set)
+        for service_name, node_name in pairs:
+            matched[service_name].add(node_name)
+        matched_nodes = set().union(*matched.values())
+    out = {"nodes": dict(), "services": dict()}
+    for node_name, node in data["nodes"].items():
+        if node_names and node_name not in node_names:
+            continue
+        if matched is not None and node_name not in matched_nodes:
+            continue
+        out["nodes"][node_name] = {
+            k: v for k, v in node.items() if not fields or k in fields
+        }
+    for service_name, service in data["services"].items():
+        if service_names and service_name not in service_names:
+            continue
+        if matched is not None and service_name not in matched:
+            continue
+        entry = dict()
+        for k, v in service.items():
+            if fields and k not in fields:
+                continue
+            if node_names and isinstance(v, dict):
+                v = {n: state for n, state in v.items() if n in node_names}
+            elif node_names and k == "nodes":
+                v = [n for n in v if n in node_names]
+            if matched is not None and isinstance(v, dict):
+                v = {n: state for n, state in v.items() if n in matched[service_name]}
+            elif matched is not None and k == "nodes":
+                v = [n for n in v if n in matched[service_name]]
+            entry[k] = v
+        out["services"][service_name] = entry
     return out
 
 
+def diff_snapshot_data(old, new):
+    """Return the entries of new that differ from old, and the removed names."""
+    out = {"nodes": dict(), "services": dict(), "removed": dict()}
+    for kind in ["nodes", "services"]:
+        out[kind] = {
+            name: entry
+            for name, entry in new[kind].items()
+            if old[kind].get(name) != entry
+        }
+        out["removed"][kind] = sorted(set(old[kind]) - set(new[kind]))
+    return out
+
+
+@functools.lru_cache(maxsize=128)
+def snapshot_api_body(version, fields, node_names, service_names, since, query=""):
+    """Return (json body, etag) for a snapshot api request.
+
+    Cached per snapshot version and query, so repeated polling by scrapers
+    costs a dict lookup. The etag only covers the selected data, so it stays
+    the same across versions in which nothing selected changed.
+    """
+    snap = find_snapshot(version)
+    pairs = snap.search_index.query(query) if query else None
+    data = filter_snapshot_data(snap.data, fields, node_names, service_names, pairs)
+    etag = hashlib.sha1(
+        json.dumps(data, sort_keys=True, default=str).encode()
+    ).hexdigest()
+    out = {"version": snap.version, "created": snap.created, "stale": snap.stale}
+    if snap.stale:
+        etag += "-stale"
+    old_snap = find_snapshot(since) if since is not None else None
+    if old_snap:
+        old_data = filter_snapshot_data(
+            old_snap.data, fields, node_names, service_names, pairs
+        )
+        out.update({"since": since, "delta": True})
+        out.update(diff_snapshot_data(old_data, data))
+        etag += f"-{since}"
+    else:
+        out.update({"delta": False})
+        out.update(data)
+    return json.dumps(out, default=str).encode(), etag
+
+
+@functools.lru_cache(maxsize=128)
+def gzip_body(body):
+    """Return body gzipped, cached since the same bodies are served repeatedly."""
+    return gzip.compress(body)
+
+
+def openmetrics_label(value):
+    """Escape a label value for the OpenMetrics text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def openmetrics_family(name, kind, help_text, samples):
+    """Return the lines of one metric family from (suffix, labels, value) samples."""
+    lines = [f"# TYPE {name} {kind}", f"# HELP {name} {help_text}"]
+    for suffix, labels, value in samples:
+        label_text = ",".join(
+            f'{k}="{openmetrics_label(v)}"' for k, v in labels.items()
+        )
+        if label_text:
+            label_text = "{" + label_text + "}"
+        lines.append(f"{name}{suffix}{label_text} {value}")
+    return lines
+
+
+@functools.lru_cache(maxsize=8)
+def openmetrics_body(version, ack_version):
+    """Return the /metrics body for a snapshot version and alerts.ack_version.
+
+    Cached, so scrapes between polls cost a dict lookup. ack_version is part
+    of the key because acknowledging an alert doesn't make a new snapshot.
+    """
+    snap = find_snapshot(version)
+    nodes = snap.nodes.nodes
+    services = snap.services.all
+    pairs = [(s, node_name) for s in services for node_name in s.nodes]
+    # (labels, key, over threshold) of every node alert
+    node_alerts = []
+    for node in nodes:
+        keys = [
+            AlertKey("mem", node.node_name, ""),
+            AlertKey("cpu", node.node_name, ""),
+        ]
+        keys += [AlertKey("disk", node.node_name, d["mounted_on"]) for d in node.df]
+        warns = [node.mem_warn, node.cpu_warn] + [d["warn"] for d in node.df]
+        for key, warn in zip(keys, warns):
+            labels = {"node": key.node_name, "kind": key.kind}
+            if key.target:
+                labels["mount"] = key.target
+            node_alerts.append((labels, key, warn))
+    lines = []
+    lines += openmetrics_family(
+        "sc_snapshot_version",
+        "gauge",
+        "Version of the snapshot these metrics come from.",
+        [("", {}, snap.version)],
+    )
+    lines += openmetrics_family(
+        "sc_snapshot_timestamp_seconds",
+        "gauge",
+        "When the snapshot was collected.",
+        [("", {}, snap.created)],
+    )
+    lines += openmetrics_family(
+        "sc_poll_duration_seconds",
+        "gauge",
+        "How long the poll cycle that made the snapshot took.",
+        [("", {}, snap.poll_ms / 1000)],
+    )
+    lines += openmetrics_family(
+        "sc_warnings",
+        "gauge",
+        "Unacknowledged warnings.",
+        [
+            ("", {"kind": "nodes"}, snap.nodes.warnings),
+            ("", {"kind": "services"}, snap.services.warnings),
+        ],
+    )
+    lines += openmetrics_family(
+        "sc_node_up",
+        "gauge",
+        "1 if the node answered the last poll.",
+        [("", {"node": n.node_name}, int(n.is_up)) for n in nodes],
+    )
+    lines += openmetrics_family(
+        "sc_node_memory_used_megabytes",
+        "gauge",
+        "Used memory as shown on the dashboard.",
+        [("", {"node": n.node_name}, n.mem_used) for n in nodes],
+    )
+    lines += openmetrics_family(
+        "sc_node_memory_total_megabytes",
+        "gauge",
+        "Total memory as shown on the dashboard.",
+        [("", {"node": n.node_name}, n.mem_avail) for n in nodes],
+    )
+    lines += openmetrics_family(
+        "sc_node_load1",
+        "gauge",
+        "One minute load average.",
+        [("", {"node": n.node_name}, n.load) for n in nodes],
+    )
+    lines += openmetrics_family(
+        "sc_node_cpus",
+        "gauge",
+        "Number of cpus.",
+        [("", {"node": n.node_name}, n.cpus) for n in nodes],
+    )
+    lines += openmetrics_family(
+        "sc_node_disk_used_gigabytes",
+        "gauge",
+        "Used disk space per mount.",
+        [
+            ("", {"node": n.node_name, "mount": d["mounted_on"]}, d["used_gb"])
+            for n in nodes
+            for d in n.df
+        ],
+    )
+    lines += openmetrics_family(
+        "sc_node_disk_total_gigabytes",
+        "gauge",
+        "Total disk space per mount.",
+        [
+            ("", {"node": n.node_name, "mount": d["mounted_on"]}, d["total_gb"])
+            for n in nodes
+            for d in n.df
+        ],
+    )
+    lines += openmetrics_family(
+        "sc_node_warnings",
+        "gauge",
+        "Unacknowledged warnings on the node.",
+        [("", {"node": n.node_name}, n.warnings) for n in nodes],
+    )
+    lines += openmetrics_family(
+        "sc_node_alert",
+        "gauge",
+        "1 if the node alert (kind mem, cpu or disk with its mount) is over its threshold.",
+        [("", labels, int(bool(warn))) for labels, _, warn in node_alerts],
+    )
+    lines += openmetrics_family(
+        "sc_node_alert_acknowledged",
+        "gauge",
+        "1 if the node alert has been acknowledged.",
+        [("", labels, int(alerts.is_acked(key))) for labels, key, _ in node_alerts],
+    )
+    lines += openmetrics_family(
+        "sc_service_state",
+        "stateset",
+        "State of the service on a node.",
+        [
+            (
+                "",
+                {"service": s.name, "node": node_name, "sc_service_state": state},
+                int(s.status.get(node_name, "unknown") == state),
+            )
+            for s, node_name in pairs
+            for state in ["active", "inactive", "unknown"]
+        ],
+    )
+    lines += openmetrics_family(
+        "sc_service_memory_megabytes",
+        "gauge",
+        "Memory used by the service's cgroup.",
+        [
+            ("", {"service": s.name, "node": node_name}, s.memory_mb[node_name])
+            for s, node_name in pairs
+            if s.memory_mb.get(node_name) is not None
+        ],
+    )
+    lines += openmetrics_family(
+        "sc_service_cpu_seconds",
+        "counter",
+        "Cpu time used by the service's cgroup.",
+        [
+            ("_total", {"service": s.name, "node": node_name}, s.cpu_seconds[node_name])
+            for s, node_name in pairs
+            if s.cpu_seconds.get(node_name) is not None
+        ],
+    )
+    lines += openmetrics_family(
+        "sc_service_alert_acknowledged",
+        "gauge",
+        "1 if the service alert on a node has been acknowledged.",
+        [
+            (
+                "",
+                {"service": s.name, "node": node_name},
+                int(alerts.is_acked(AlertKey("service", node_name, s.name))),
+            )
+            for s, node_name in pairs
+        ],
+    )
+    lines.append("# EOF\n")
+    return "\n".join(lines).encode()
+
+
+class ConfigCache:
+    """The parsed config and the live Services and Nodes built from it.
+
+    The file is only re-read when its mtime changes and only re-parsed when
+    its content hash changes. On reload, Service and Node objects whose
+    definition didn't change are kept along with their collected state.
+    """
+
+    def __init__(self):
+        """Initialize class variables."""
+        self.path = None
+        self.mtime_ns = None
+        self.digest = None
+        self.services = None
+        self.nodes = None
+
+    def load(self, path):
+        """Return (services, nodes, changed) for the config file at path."""
+        mtime_ns = os.stat(path).st_mtime_ns
+        if path == self.path and mtime_ns == self.mtime_ns:
+            return self.services, self.nodes, False
+        text = pathlib.Path(path).read_text()
+        digest = hashlib.sha256(text.encode()).hexdigest()
+        self.path = path
+        self.mtime_ns = mtime_ns
+        if digest == self.digest:
+            return self.services, self.nodes, False
+        with perf.timed("phase", "config parse"):
+            self.services = Services(text, old=self.services)
+            self.nodes = Nodes(self.services.get_node_names(), old=self.nodes)
+        self.digest = digest
+        pairs = [
+            (s.name, node_name) for s in self.services.all for node_name in s.nodes
+        ]
+        history.forget(self.services.get_node_names(), pairs)
+        alerts.forget(self.services.get_node_names(), pairs)
+        node_facts.forget(self.services.get_node_names())
+        print(f"loaded {path}, {len(self.services.new_pairs)} new service/node pairs")
+        return self.services, self.nodes, True
+
+
+config_cache = ConfigCache()
+
+
+def make_snapshot(version, services, nodes, poll_ms):
+    """Return a snapshot holding a copy of the live services and nodes."""
+    config = services.config
+    diagram = services.mermaid_diagram
+    # snapshots share the config and the parsed diagram rather than copies
+    with perf.timed("phase", "snapshot copy"):
+        services, nodes = copy.deepcopy(
+            (services, nodes), {id(config): config, id(diagram): diagram}
+        )
+    mermaid_diagram = None
+    if version and diagram:
+        with perf.timed("phase", "mermaid diagram"):
+            mermaid_diagram = diagram.render(services)
+    return Snapshot(version, config, services, nodes, mermaid_diagram, poll_ms)
+
+
+def publish_snapshot(services, nodes, poll_ms):
+    """Sum up the collected state and publish it as the next snapshot."""
+    global snapshot
+    with perf.timed("phase", "totals"):
+        nodes.update_totals()
+    with perf.timed("phase", "warnings table"):
+        services.update_warnings()
+    version = snapshot.version + 1 if snapshot else 1
+    snapshot = make_snapshot(version, services, nodes, poll_ms)
+    remember_snapshot(snapshot)
+    state_store.save_snapshot(snapshot)
+    print(f"published snapshot {version} in {poll_ms:.0f}ms")
+    with perf.timed("phase", "dashboard cells"):
+        push_dashboard_cells(snapshot)
+
+
+def dashboard_cells(snap):
+    """Render every live-updatable cell of the dashboard, keyed by cell id."""
+    cells = app.jinja_env.get_template("cells.jinja2").module
+    out = dict()
+    for service in snap.services.all:
+        for node_name in service.nodes:
+            out[cell_id("status", service.name, node_name)] = cells.status_string(
+                service.status.get(node_name)
+            )
+            out[cell_id("service_info", service.name, node_name)] = cells.service_info(
+                service, node_name
+            )
+    for node in snap.nodes.nodes:
+        name = node.node_name
+        out[cell_id("node_down", name)] = cells.node_down(node)
+        out[cell_id("node_times", name)] = cells.node_times(node)
+        out[cell_id("mem_warn", name)] = cells.warn_symbol(node.mem_warn)
+        out[cell_id("node_mem", name)] = cells.node_mem(node)
+        out[cell_id("cpu_warn", name)] = cells.warn_symbol(node.cpu_warn)
+        out[cell_id("node_load", name)] = cells.node_load(node)
+        for df_data in node.df:
+            mounted_on = df_data["mounted_on"]
+            out[cell_id("disk_warn", name, mounted_on)] = cells.warn_symbol(
+                df_data["warn"]
+            )
+            out[cell_id("disk", name, mounted_on)] = cells.disk_usage(df_data)
+    out[cell_id("services_warnings")] = cells.warnings_badge(snap.services.warnings)
+    out[cell_id("nodes_warnings")] = cells.warnings_badge(snap.nodes.warnings)
+    out[cell_id("total_mem")] = cells.total_mem(snap.nodes)
+    out[cell_id("total_load")] = cells.total_load(snap.nodes)
+    out[cell_id("total_disk")] = cells.total_disk(snap.nodes)
+    out[cell_id("stale")] = cells.stale_marker(snap.stale)
+    if snap.mermaid_diagram:
+        out[cell_id("mermaid")] = snap.mermaid_diagram
+    return {k: str(v) for k, v in out.items()}
+
+
+live_cells = (None, dict())
+
+
+def push_dashboard_cells(snap):
+    """Send the dashboard cells that changed in snap to all dashboard viewers.
+
+    Rendering happens once per snapshot, whatever the number of viewers. If
+    the set of cells changed, for example after a config change added a node,
+    viewers are asked to reload the page instead.
+    """
+    global live_cells
+    cells = dashboard_cells(snap)
+    _, old_cells = live_cells
+    live_cells = (snap, cells)
+    if cells.keys() != old_cells.keys():
+        socketio.emit("reload", namespace="/dashboard")
+        return
+    changed = {k: v for k, v in cells.items() if old_cells[k] != v}
+    socketio.emit("cells", live_cells_message(snap, changed), namespace="/dashboard")
+
+
+def live_cells_message(snap, cells):
+    """Return the message sent to dashboard viewers."""
+    return {
+        "version": snap.version,
+        "warnings": snap.nodes.warnings + snap.services.warnings,
+        "cells": cells,
+    }
+
+
+@socketio.on("hello", namespace="/dashboard")
+def dashboard_hello(data):
+    """Catch up a dashboard viewer whose page is older than the live cells."""
+    snap, cells = live_cells
+    if cells and data.get("version") != snap.version:
+        flask_socketio.emit("cells", live_cells_message(snap, cells))
+
+
+class PollSchedule:
+    """When each node is next due to be polled.
+
+    Nodes are polled every cfg_poll_interval, URGENT_POLL_FACTOR times as
+    often while they have unacknowledged warnings or services that aren't
+    active, and exponentially less often (up to MAX_POLL_BACKOFF) while
+    they are down. Due times are jittered, so that polls spread over the
+    interval instead of all happening at once.
+    """
+
+    def __init__(self):
+        """Initialize class variables."""
+        self.next_due = dict()
+        self.failures = dict()
+
+    def due(self, nodes, now):
+        """Return the nodes that are due a poll."""
+        return [
+            node for node in nodes.nodes if self.next_due.get(node.node_name, 0) <= now
+        ]
+
+    def interval(self, node):
+        """Return the time until the node's next poll, before jitter."""
+        failures = self.failures.get(node.node_name, 0)
+        if failures:
+            return min(cfg_poll_interval * 2 ** (failures - 1), MAX_POLL_BACKOFF)
+        if alerts.warnings("nodes", node.node_name) or alerts.warnings(
+            "services", node.node_name
+        ):
+            return cfg_poll_interval / URGENT_POLL_FACTOR
+        return cfg_poll_interval
+
+    def polled(self, node):
+        """Schedule the next poll of a node that was just polled."""
+        node_name = node.node_name
+        if node.is_up:
+            self.failures.pop(node_name, None)
+        else:
+            self.failures[node_name] = self.failures.get(node_name, 0) + 1
+        # the first polls all happen together, so spread the next ones out
+        if node_name in self.next_due:
+            jitter = random.uniform(0.8, 1.2)
+        else:
+            jitter = random.uniform(0.1, 1)
+        self.next_due[node_name] = time.time() + self.interval(node) * jitter
+
+
+poll_schedule = PollSchedule()
+
+
+def poll_node(node, services):
+    """Collect a node and schedule its next poll, even if collecting failed."""
+    try:
+        collect_node(node, services)
+    except Exception:
+        node.is_up = False
+        alerts.set(AlertKey("down", node.node_name, ""), True)
+        raise
+    finally:
+        poll_schedule.polled(node)
+
+
+def poll_fleet(force=False):
+    """Poll the nodes that are due (or all of them) and publish a snapshot.
+
+    Nodes with services that were added to the config are polled straight
+    away. Nothing is published if no node was due and the config didn't
+    change.
+    """
+    collection_cancelled.clear()
+    time_now = time.time()
+    services, nodes, changed = config_cache.load(cfg_services_yaml)
+    if cfg_agent:
+        agents.sync(services.by_node)
+    if force:
+        due = list(nodes.nodes)
+    else:
+        due = poll_schedule.due(nodes, time_now)
+        new_node_names = {node_name for _, node_name in services.new_pairs}
+        due += [
+            node
+            for node in nodes.nodes
+            if node.node_name in new_node_names and node not in due
+        ]
+    if not due and not changed:
+        return
+    tasks = [
+        functools.partial(poll_node, node, services.by_node[node.node_name])
+        for node in due
+    ]
+    with perf.timed("phase", "collect"):
+        fan_out(tasks)
+    node_facts.save()
+    if collection_cancelled.is_set():
+        raise CollectionCancelled()
+    services.new_pairs = set()
+    publish_snapshot(services, nodes, (time.time() - time_now) * 1000)
+    perf.record("phase", "poll", time.time() - time_now)
+
+
+def poller():
+    """Background loop keeping the fleet snapshot fresh.
+
+    Every POLL_TICK seconds, or straight away when a refresh is requested,
+    the nodes that are due are polled. Refresh requests that arrive while
+    a poll is running are coalesced into that poll rather than starting
+    another one.
+    """
+    while True:
+        try:
+            poll_fleet(force=poll_now.is_set())
+        except CollectionCancelled:
+            print("poll cancelled")
+            continue
+        except Exception as e:
+            print(f"poll failed: {e}")
+        transport.expire_idle()
+        reap_log_streams()
+        terminals.reap_unattached()
+        poll_now.clear()
+        poll_now.wait(timeout=POLL_TICK)
+
+
+def request_refresh():
+    """Wake the poller up early."""
+    poll_now.set()
+
+
+JOB_ACTIONS = ["start", "stop", "restart"]
+# attempts per service/node pair, and the wait between them
+JOB_ATTEMPTS = 2
+JOB_RETRY_DELAY = 2
+# finished jobs that are kept for their status pages
+JOB_HISTORY = 100
+
+
+class Job:
+    """A systemctl start, stop or restart of service/node pairs.
+
+    Each pair is tried up to JOB_ATTEMPTS times, each attempt limited to
+    cfg_job_timeout seconds. Progress is emitted to the job's room on the
+    /jobs namespace.
+    """
+
+    def __init__(self, action, pairs):
+        """Initialize class variables."""
+        self.job_id = uuid.uuid4().hex[:12]
+        self.action = action
+        self.pairs = pairs
+        self.state = {pair: "queued" for pair in pairs}
+        self.attempts = {pair: 0 for pair in pairs}
+        self.errors = dict()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+
+    def emit(self, event, data):
+        """Send an event to everyone watching this job."""
+        socketio.emit(event, data, to=self.job_id, namespace="/jobs")
+
+    def set_state(self, pair, state):
+        """Set a pair's state and tell the watchers."""
+        with self.lock:
+            self.state[pair] = state
+            done = all(s in ["ok", "failed"] for s in self.state.values())
+            if done and not self.finished:
+                self.finished = time.time()
+            else:
+                done = False
+        self.emit("state", self.pair_state(pair))
+        if done:
+            self.emit("summary", self.summary())
+            request_refresh()
+
+    def run_pair(self, pair):
+        """Run the action on one service/node pair, retrying if it fails."""
+        service_name, node_name = pair
+        service = snapshot.services.by_name.get(service_name)
+        if not service:
+            self.errors[pair] = "no longer configured"
+            self.set_state(pair, "failed")
+            return
+        for attempt in range(1, JOB_ATTEMPTS + 1):
+            self.attempts[pair] = attempt
+            self.set_state(pair, "running")
+            try:
+                service.systemctl(
+                    self.action, node_name, deadline=time.time() + cfg_job_timeout
+                )
+            except TransportError as e:
+                self.errors[pair] = str(e)
+                if attempt < JOB_ATTEMPTS:
+                    self.set_state(pair, "retrying")
+                    time.sleep(JOB_RETRY_DELAY)
+                continue
+            except Exception as e:
+                # not worth retrying, but the job still has to finish
+                self.errors[pair] = repr(e)
+                break
+            self.errors.pop(pair, None)
+            self.set_state(pair, "ok")
+            return
+        self.set_state(pair, "failed")
+
+    def pair_state(self, pair):
+        """Return the state of a pair as sent to watchers."""
+        return {
+            "service": pair[0],
+            "node_name": pair[1],
+            "state": self.state[pair],
+            "attempts": self.attempts[pair],
+            "error": self.errors.get(pair),
+        }
+
+    def summary(self):
+        """Return the job's state and counts of pairs by state."""
+        return {
+            "job_id": self.job_id,
+            "action": self.action,
+            "pairs": [self.pair_state(pair) for pair in self.pairs],
+            "counts": collections.Counter(self.state.values()),
+            "started": self.started,
+            "finished": self.finished,
+            "duration": (self.finished or time.time()) - self.started,
+        }
+
+
+class JobQueue:
+    """Jobs run in the background on a pool of cfg_parallelism workers.
+
+    Requests only queue a job and return its id, so a hung node never ties
+    up a request handler.
+    """
+
+    def __init__(self):
+        """Initialize class variables."""
+        self.jobs = collections.OrderedDict()
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def submit(self, action, pairs):
+        """Queue an action on service/node pairs and return the job."""
+        job = Job(action, pairs)
+        with self.lock:
+            if not self.executor:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=cfg_parallelism
+                )
+            self.jobs[job.job_id] = job
+            finished = [j for j in self.jobs.values() if j.finished]
+            for old_job in finished[: max(len(finished) - JOB_HISTORY, 0)]:
+                del self.jobs[old_job.job_id]
+        for pair in pairs:
+            self.executor.submit(job.run_pair, pair)
+        return job
+
+    def recent(self):
+        """Return the jobs, newest first."""
+        with self.lock:
+            return list(reversed(self.jobs.values()))
+
+
+jobs = JobQueue()
+
+
+def job_response(job, redirect_to):
+    """Return the job summary for ?json=1 requests, or redirect."""
+    if flask.request.args.get("json"):
+        return flask.Response(
+            json.dumps(job.summary()), status=202, mimetype="application/json"
+        )
+    return flask.redirect(redirect_to)
+
+
+def is_configured_pair(services, pair):
+    """Return if pair is a (service name, node name) the config has."""
+    return (
+        len(pair) == 2
+        and pair[0] in services.by_name
+        and pair[1] in services.by_name[pair[0]].nodes
+    )
+
+
+def pair_job(action, service, node_name):
+    """Submit a job for one service/node pair and return the response."""
+    if not is_configured_pair(snapshot.services, (service, node_name)):
+        flask.abort(400)
+    job = jobs.submit(action, [(service, node_name)])
+    return job_response(job, flask.url_for("index"))
+
+
 @app.route("/start/<service>/<node_name>")
 def start(service, node_name):
     """Start service on node endpoint."""
-    services.by_name[service].start(node_name)
-    return flask.redirect(flask.url_for("index"))
+    return pair_job("start", service, node_name)
 
 
 @app.route("/stop/<service>/<node_name>")
 def stop(service, node_name):
     """Stop service on node endpoint."""
-    services.by_name[service].stop(node_name)
-    return flask.redirect(flask.url_for("index"))
+    return pair_job("stop", service, node_name)
+
+
+@app.route("/restart/<service>/<node_name>")
+def restart(service, node_name):
+    """Restart service on node endpoint."""
+    return pair_job("restart", service, node_name)
+
+
+@app.route("/bulk/<action>")
+def bulk_action(action):
+    """Start, stop or restart many service/node pairs at once endpoint.
+
+    Query arguments: service (all of its nodes), node (all of its services)
+    or pairs (comma separated SERVICE/NODE). They fan out concurrently.
+    """
+    if action not in JOB_ACTIONS:
+        flask.abort(400)
+    services = snapshot.services
+    args = flask.request.args
+    if args.get("service"):
+        service = services.by_name.get(args["service"])
+        if not service:
+            flask.abort(400)
+        pairs = [(service.name, node_name) for node_name in service.nodes]
+    elif args.get("node"):
+        # by_node is a defaultdict, so don't add unknown nodes to the snapshot
+        node_services = services.by_node.get(args["node"], [])
+        pairs = [(s.name, args["node"]) for s in node_services]
+    else:
+        pairs = [tuple(pair.split("/", 1)) for pair in split_arg("pairs")]
+    pairs = [pair for pair in pairs if is_configured_pair(services, pair)]
+    if not pairs:
+        flask.abort(400)
+    job = jobs.submit(action, pairs)
+    return job_response(job, flask.url_for("job_status", job_id=job.job_id))
+
+
+@app.route("/jobs")
+def jobs_list():
+    """Recent jobs json endpoint."""
+    return flask.Response(
+        json.dumps([job.summary() for job in jobs.recent()]),
+        mimetype="application/json",
+    )
+
 
+@app.route("/job/<job_id>")
+def job_status(job_id):
+    """Job progress page endpoint. Add ?json=1 for the summary."""
+    job = jobs.jobs.get(job_id)
+    if not job:
+        flask.abort(404)
+    if flask.request.args.get("json"):
+        return flask.Response(json.dumps(job.summary()), mimetype="application/json")
+    return flask.render_template(
+        "job.jinja2",
+        job=job,
+        job_attempts=JOB_ATTEMPTS,
+        job_timeout=cfg_job_timeout,
+        title=f"sillycat {job.action} {len(job.pairs)} services",
+    )
 
-@app.route("/restart/<service>/<node_name>")
-def restart(service, node_name):
-    """Restart service on node endpoint."""
-    services.by_name[service].restart(node_name)
-    return flask.redirect(flask.url_for("index"))
+
+@socketio.on("watch", namespace="/jobs")
+def job_watch(data):
+    """Join a job's room and catch up on its state."""
+    job = jobs.jobs.get(data.get("job_id"))
+    if not job:
+        return
+    flask_socketio.join_room(job.job_id)
+    flask_socketio.emit("catchup", job.summary())
 
 
 def web_run_term(cmd):
     """Start either a native or web terminal."""
     if cfg_term_program == "xtermjs":
-        app.config["cmd"] = cmd
-        return flask.render_template("term.jinja2")
+        session = terminals.create(cmd)
+        return flask.render_template("term.jinja2", session_id=session.session_id)
     else:
         term_cmd = cfg_term_program.split() + cmd
         subprocess.Popen(term_cmd)
@@ -379,112 +2921,694 @@ def web_run_term(cmd):
 @app.route("/open_terminal_log/<service>/<node_name>")
 def open_terminal_log(service, node_name):
     """Open terminal log on node endpoint."""
-    cmd = ["ssh", "root@" + node_name, "journalctl", "-fu", service]
+    cmd = transport.command(node_name, "journalctl", "-fu", service)
     return web_run_term(cmd)
 
 
 @app.route("/open_terminal_shell/<service>/<node_name>")
 def open_terminal_shell(service, node_name):
     """Open terminal shell on node endpoint."""
-    cmd = ["ssh", "root@" + node_name]
+    cmd = transport.command(node_name)
     return web_run_term(cmd)
 
 
-@app.route("/deploy/<service>/<node_name>")
-def deploy(service, node_name):
-    """Deploy service on node endpoint."""
-    script = services.by_name[service].deploy(node_name)
-    print(script)
-    with open(f"/tmp/deploy.{service}.{node_name}.sh", "w") as f:
+LOG_PRIORITIES = ["emerg", "alert", "crit", "err", "warning", "notice", "info", "debug"]
+# lines of each node's journal shown from before the stream started
+LOG_BACKLOG_LINES = 20
+# matching lines kept per node while the viewer is behind, oldest dropped first
+LOG_BUFFER_LINES = 1000
+# how long lines are held, so that lines from slower nodes are merged in order
+LOG_MERGE_DELAY = 0.5
+# frames the browser hasn't shown yet before we stop sending
+LOG_MAX_UNACKED_FRAMES = 4
+# streams without viewers are stopped after this long
+LOG_IDLE_TIMEOUT = 30
+
+
+def parse_journal_line(line):
+    """Return (time, priority, message) of a journalctl -o json line.
+
+    Lines that aren't json (e.g. errors from ssh) are returned as they are,
+    with the current time and priority info.
+    """
+    try:
+        entry = json.loads(line)
+        message = entry.get("MESSAGE", "")
+        # messages that aren't valid utf-8 come as lists of bytes
+        if isinstance(message, list):
+            message = bytes(message).decode(errors="replace")
+        return (
+            int(entry.get("__REALTIME_TIMESTAMP", 0)) / 1e6,
+            int(entry.get("PRIORITY", 6)),
+            str(message),
+        )
+    except (ValueError, TypeError, AttributeError):
+        return time.time(), 6, line.decode(errors="replace").rstrip("\n")
+
+
+class LogStream:
+    """A service's journal followed on all of its nodes, merged for one page.
+
+    journalctl -f runs on every node over ssh with json output, read by a
+    thread per node. Lines that don't match the filter are dropped as they
+    are read, and matching ones wait in a buffer of at most
+    LOG_BUFFER_LINES per node. Every LOG_MERGE_DELAY the buffers are merged
+    by timestamp and emitted to the stream's room on the /logs namespace.
+    While the browser has LOG_MAX_UNACKED_FRAMES frames it hasn't shown,
+    nothing is sent and buffers drop their oldest lines, so a slow viewer
+    costs bounded memory. Dropped lines are counted and reported.
+    """
+
+    def __init__(self, service, grep, priority):
+        """Initialize class variables."""
+        self.log_id = uuid.uuid4().hex[:12]
+        self.service = service
+        self.node_names = list(service.nodes)
+        self.grep = grep
+        self.priority = priority
+        self.buffers = {
+            node_name: collections.deque(maxlen=LOG_BUFFER_LINES)
+            for node_name in self.node_names
+        }
+        self.dropped = {node_name: 0 for node_name in self.node_names}
+        self.procs = dict()
+        self.lock = threading.Lock()
+        self.viewers = set()
+        self.idle_since = time.monotonic()
+        self.sent = 0
+        self.acked = 0
+        self.started = False
+        self.stopped = False
+
+    def start(self):
+        """Start following the journal on every node."""
+        self.started = True
+        for node_name in self.node_names:
+            cmd = transport.argv(
+                node_name,
+                "journalctl",
+                "-f",
+                "-u",
+                self.service.name,
+                "-o",
+                "json",
+                "-n",
+                str(LOG_BACKLOG_LINES),
+            )
+            proc = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            )
+            self.procs[node_name] = proc
+            socketio.start_background_task(self.read_loop, node_name, proc)
+        socketio.start_background_task(self.send_loop)
+
+    def stop(self):
+        """Stop following the journals."""
+        self.stopped = True
+        for proc in self.procs.values():
+            proc.terminate()
+        log_streams.pop(self.log_id, None)
+
+    def add(self, node_name, time_s, priority, message):
+        """Buffer a line for sending, dropping the oldest if the buffer is full."""
+        with self.lock:
+            buffer = self.buffers[node_name]
+            if len(buffer) == buffer.maxlen:
+                self.dropped[node_name] += 1
+            buffer.append((time_s, time.monotonic(), node_name, priority, message))
+
+    def read_loop(self, node_name, proc):
+        """Buffer the lines of a node's journal that match the filter."""
+        for line in proc.stdout:
+            time_s, priority, message = parse_journal_line(line)
+            if priority > self.priority:
+                continue
+            if self.grep and not self.grep.search(message):
+                continue
+            self.add(node_name, time_s, priority, message)
+        proc.wait()
+        if not self.stopped:
+            self.add(node_name, time.time(), 6, "*** sc: journal stream ended")
+
+    def take(self):
+        """Remove the lines that waited LOG_MERGE_DELAY and return them by time."""
+        ready_at = time.monotonic() - LOG_MERGE_DELAY
+        per_node = []
+        with self.lock:
+            for node_name, buffer in self.buffers.items():
+                lines = []
+                if self.dropped[node_name]:
+                    # shown just before the oldest line that was kept
+                    time_s = buffer[0][0] if buffer else time.time()
+                    message = f"*** sc: dropped {self.dropped[node_name]} lines"
+                    lines.append((time_s, 0, node_name, 6, message))
+                    self.dropped[node_name] = 0
+                while buffer and buffer[0][1] <= ready_at:
+                    lines.append(buffer.popleft())
+                per_node.append(lines)
+        return list(heapq.merge(*per_node))
+
+    def send_loop(self):
+        """Send merged lines to the viewers until the stream is stopped."""
+        while not self.stopped:
+            time.sleep(LOG_MERGE_DELAY)
+            if not self.viewers:
+                if time.monotonic() - self.idle_since > LOG_IDLE_TIMEOUT:
+                    self.stop()
+                continue
+            if self.sent - self.acked >= LOG_MAX_UNACKED_FRAMES:
+                continue
+            lines = self.take()
+            if not lines:
+                continue
+            self.sent += 1
+            socketio.emit(
+                "lines",
+                {
+                    "seq": self.sent,
+                    "lines": [
+                        [time_s, node_name, priority, message]
+                        for time_s, _, node_name, priority, message in lines
+                    ],
+                },
+                to=self.log_id,
+                namespace="/logs",
+            )
+
+    def attach(self, sid):
+        """A browser started watching the stream."""
+        self.viewers.add(sid)
+        self.acked = self.sent
+        if not self.started:
+            self.start()
+
+    def detach(self, sid):
+        """A browser went away."""
+        self.viewers.discard(sid)
+        if not self.viewers:
+            self.idle_since = time.monotonic()
+
+
+log_streams = dict()
+
+
+def reap_log_streams():
+    """Forget streams whose page didn't connect within LOG_IDLE_TIMEOUT.
+
+    Started streams stop themselves once idle, but a stream only starts
+    when its page connects.
+    """
+    now = time.monotonic()
+    for log_stream in list(log_streams.values()):
+        if not log_stream.started and now - log_stream.idle_since > LOG_IDLE_TIMEOUT:
+            log_streams.pop(log_stream.log_id, None)
+
+
+@atexit.register
+def stop_log_streams():
+    """Stop every log stream."""
+    for log_stream in list(log_streams.values()):
+        log_stream.stop()
+
+
+@app.route("/logs/<service>")
+def fleet_logs(service):
+    """Follow service's journal on all of its nodes endpoint.
+
+    Query arguments: grep (a case insensitive regular expression) and level
+    (the least important journal priority shown, e.g. warning).
+    """
+    args = flask.request.args
+    grep = args.get("grep", "")
+    try:
+        grep_re = re.compile(grep, re.IGNORECASE) if grep else None
+    except re.error:
+        grep_re = re.compile(re.escape(grep), re.IGNORECASE)
+    level = args.get("level", "debug")
+    if level not in LOG_PRIORITIES:
+        flask.abort(400)
+    if service not in snapshot.services.by_name:
+        flask.abort(404)
+    reap_log_streams()
+    log_stream = LogStream(
+        snapshot.services.by_name[service], grep_re, LOG_PRIORITIES.index(level)
+    )
+    log_streams[log_stream.log_id] = log_stream
+    return flask.render_template(
+        "logs.jinja2",
+        log_stream=log_stream,
+        grep=grep,
+        level=level,
+        levels=LOG_PRIORITIES,
+        title=f"sillycat logs {service}",
+    )
+
+
+@socketio.on("watch", namespace="/logs")
+def fleet_logs_watch(data):
+    """Join a log stream's room, starting the stream if needed."""
+    log_stream = log_streams.get(data.get("log_id"))
+    if not log_stream:
+        flask_socketio.emit("gone", {})
+        return
+    flask_socketio.join_room(log_stream.log_id)
+    log_stream.attach(flask.request.sid)
+
+
+@socketio.on("ack", namespace="/logs")
+def fleet_logs_ack(data):
+    """Browser has shown a frame of log lines."""
+    log_stream = log_streams.get(data.get("log_id"))
+    if log_stream:
+        log_stream.acked = max(log_stream.acked, data.get("seq", 0))
+
+
+@socketio.on("disconnect", namespace="/logs")
+def fleet_logs_disconnect():
+    """Forget a browser that went away."""
+    for log_stream in list(log_streams.values()):
+        log_stream.detach(flask.request.sid)
+
+
+def write_script(prefix, script):
+    """Write a generated script to a new file in /tmp and return its path."""
+    with tempfile.NamedTemporaryFile(
+        "w", prefix=prefix, suffix=".sh", delete=False
+    ) as f:
         f.write(script)
+    return f.name
+
+
+def run_service_script(action, service_name, node_name):
+    """Run a deploy, delete or update of a service on a node in a terminal.
+
+    The terminal says whether the script succeeded before it waits.
+    """
+    service = snapshot.services.by_name.get(service_name)
+    if not service or node_name not in service.nodes:
+        flask.abort(404)
+    script = getattr(service, action)(node_name)
+    print(script)
+    script_path = write_script(f"{action}.{service_name}.{node_name}.", script)
+    title = action.capitalize()
     cmd = [
         "bash",
         "-c",
-        f"bash /tmp/deploy.{service}.{node_name}.sh; echo '\n\nDeploy finished\n\n'; sleep infinity",
+        f"bash {script_path}; status=$?; rm -f {script_path}; if [ $status = 0 ]; "
+        f"then echo '\n\n{title} finished\n\n'; "
+        f'else echo "\n\n{title} FAILED with exit status $status\n\n"; fi; '
+        "sleep infinity",
     ]
     return web_run_term(cmd)
 
 
+@app.route("/deploy/<service>/<node_name>")
+def deploy(service, node_name):
+    """Deploy service on node endpoint."""
+    return run_service_script("deploy", service, node_name)
+
+
 @app.route("/delete/<service>/<node_name>")
 def delete(service, node_name):
     """Delete service on node endpoint."""
-    script = services.by_name[service].delete(node_name)
-    print(script)
-    with open(f"/tmp/delete.{service}.{node_name}.sh", "w") as f:
-        f.write(script)
-    cmd = [
-        "bash",
-        "-c",
-        f"bash /tmp/delete.{service}.{node_name}.sh; echo '\n\nDelete finished\n\n'; sleep infinity",
-    ]
-    return web_run_term(cmd)
+    return run_service_script("delete", service, node_name)
 
 
 @app.route("/update/<service>/<node_name>")
 def update(service, node_name):
     """Update service on node endpoint."""
-    script = services.by_name[service].update(node_name)
-    print(script)
-    with open(f"/tmp/update.{service}.{node_name}.sh", "w") as f:
-        f.write(script)
-    cmd = [
-        "bash",
-        "-c",
-        f"bash /tmp/update.{service}.{node_name}.sh; echo '\n\nUpdate finished\n\n'; sleep infinity",
-    ]
-    return web_run_term(cmd)
+    return run_service_script("update", service, node_name)
+
+
+FLEET_DEPLOY_OUTPUT_LINES = 200
+# seconds between frames of output sent to the watchers
+FLEET_DEPLOY_FRAME_INTERVAL = 0.2
+# frames sent but not yet shown by a browser before output waits
+FLEET_DEPLOY_MAX_UNACKED_FRAMES = 4
+
+
+def kill_process_group(p):
+    """Kill a process started with start_new_session and everything it started."""
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class FleetDeploy:
+    """A deploy, delete or update of a service on all of its nodes.
+
+    Nodes are done in batches of batch_size at a time. The rollout stops
+    after the first batch where a node's script failed or, with
+    health_check, where a node of a deploy or update doesn't have the
+    service active.
+    Progress is emitted to the deploy's room on the /fleet_deploy namespace.
+    Output lines are sent in frames every FLEET_DEPLOY_FRAME_INTERVAL, and
+    while FLEET_DEPLOY_MAX_UNACKED_FRAMES frames haven't been acked lines
+    wait, at most FLEET_DEPLOY_OUTPUT_LINES per node.
+    """
+
+    def __init__(self, service, action, batch_size, health_check):
+        """Initialize class variables."""
+        self.deploy_id = uuid.uuid4().hex[:12]
+        self.service = service
+        self.action = action
+        self.batch_size = max(1, batch_size)
+        self.health_check = health_check and action != "delete"
+        self.state = {node_name: "pending" for node_name in service.nodes}
+        self.output = {
+            node_name: collections.deque(maxlen=FLEET_DEPLOY_OUTPUT_LINES)
+            for node_name in service.nodes
+        }
+        self.pending = {
+            node_name: collections.deque(maxlen=FLEET_DEPLOY_OUTPUT_LINES)
+            for node_name in service.nodes
+        }
+        self.dropped = {node_name: 0 for node_name in service.nodes}
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.acked = 0
+        self.started = time.time()
+        self.finished = None
+
+    def emit(self, event, data):
+        """Send an event to everyone watching this deploy."""
+        socketio.emit(event, data, to=self.deploy_id, namespace="/fleet_deploy")
+
+    def set_state(self, node_name, state):
+        """Set a node's state and tell the watchers."""
+        self.state[node_name] = state
+        self.emit("state", {"node_name": node_name, "state": state})
+
+    def add_output(self, node_name, line):
+        """Keep a line of a node's output for the next frame."""
+        with self.lock:
+            self.output[node_name].append(line)
+            pending = self.pending[node_name]
+            if len(pending) == pending.maxlen:
+                self.dropped[node_name] += 1
+            pending.append(line)
+
+    def take(self):
+        """Remove the lines waiting to be sent and return them as [node, line]."""
+        lines = []
+        with self.lock:
+            for node_name, pending in self.pending.items():
+                if self.dropped[node_name]:
+                    message = f"*** sc: dropped {self.dropped[node_name]} lines\n"
+                    lines.append([node_name, message])
+                    self.dropped[node_name] = 0
+                lines.extend([node_name, line] for line in pending)
+                pending.clear()
+        return lines
+
+    def send_loop(self):
+        """Send frames of output to the watchers until the rollout finished."""
+        while True:
+            finished = self.finished
+            if not finished:
+                time.sleep(FLEET_DEPLOY_FRAME_INTERVAL)
+                if self.sent - self.acked >= FLEET_DEPLOY_MAX_UNACKED_FRAMES:
+                    continue
+            lines = self.take()
+            if lines:
+                self.sent += 1
+                self.emit("output", {"seq": self.sent, "lines": lines})
+            if finished:
+                return
+
+    def catchup(self):
+        """Return the output the watchers have been sent, by node."""
+        with self.lock:
+            self.acked = self.sent
+            return {
+                node_name: "".join(
+                    list(output)[: len(output) - len(self.pending[node_name])]
+                )
+                for node_name, output in self.output.items()
+            }
+
+    def run_on_node(self, node_name, script_path):
+        """Run the script for a node, streaming its output."""
+        self.set_state(node_name, "running")
+        started = time.time()
+        p = subprocess.Popen(
+            ["bash", script_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+            start_new_session=True,
+        )
+        # ssh holds the output open after bash is gone, so kill the whole group
+        timer = threading.Timer(cfg_deploy_timeout, kill_process_group, [p])
+        timer.start()
+        for line in p.stdout:
+            self.add_output(node_name, line)
+        returncode = p.wait()
+        timer.cancel()
+        if time.time() - started >= cfg_deploy_timeout:
+            self.add_output(node_name, f"killed after {cfg_deploy_timeout}s\n")
+        perf.record(
+            "command",
+            f"fleet {self.action}",
+            time.time() - started,
+            node=node_name,
+            service=self.service.name,
+        )
+        if returncode != 0:
+            self.set_state(node_name, "failed")
+        elif self.health_check:
+            self.set_state(node_name, "checking")
+            probe = Service(self.service.service_dict)
+            probe.update_status_on_node(node_name)
+            ok = probe.status[node_name] == "active"
+            self.set_state(node_name, "ok" if ok else "unhealthy")
+        else:
+            self.set_state(node_name, "ok")
+
+    def run(self):
+        """Run the rollout batch by batch."""
+        nodes = list(self.service.nodes)
+        # generating a script opens the node's ssh master connection, so
+        # generate them for all nodes at once
+        with concurrent.futures.ThreadPoolExecutor(cfg_parallelism) as executor:
+            scripts = executor.map(getattr(self.service, self.action), nodes)
+            script_paths = {
+                node_name: write_script(f"fleet.{self.deploy_id}.{node_name}.", script)
+                for node_name, script in zip(nodes, scripts)
+            }
+        socketio.start_background_task(target=self.send_loop)
+        try:
+            self.run_batches(nodes, script_paths)
+        finally:
+            for script_path in script_paths.values():
+                os.unlink(script_path)
+            self.finished = time.time()
+        self.emit("summary", self.summary())
+        request_refresh()
+
+    def run_batches(self, nodes, script_paths):
+        """Run the nodes' scripts a batch at a time, stopping at a failed batch."""
+        for i in range(0, len(nodes), self.batch_size):
+            batch = nodes[i : i + self.batch_size]
+            with concurrent.futures.ThreadPoolExecutor(len(batch)) as executor:
+                futures = {
+                    executor.submit(
+                        self.run_on_node, node_name, script_paths[node_name]
+                    ): node_name
+                    for node_name in batch
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    if future.exception():
+                        node_name = futures[future]
+                        self.add_output(node_name, f"error: {future.exception()}\n")
+                        self.set_state(node_name, "failed")
+            if any(self.state[n] != "ok" for n in batch):
+                for node_name in nodes[i + self.batch_size :]:
+                    self.set_state(node_name, "skipped")
+                break
+
+    def summary(self):
+        """Return the deploy's state and counts of nodes by state."""
+        return {
+            "deploy_id": self.deploy_id,
+            "service": self.service.name,
+            "action": self.action,
+            "batch_size": self.batch_size,
+            "health_check": self.health_check,
+            "state": self.state,
+            "counts": collections.Counter(self.state.values()),
+            "started": self.started,
+            "finished": self.finished,
+            "duration": (self.finished or time.time()) - self.started,
+        }
+
+
+fleet_deploys = dict()
+# finished fleet deploys that are kept for their status pages
+FLEET_DEPLOY_HISTORY = 20
+
+
+@app.route("/deploy_fleet/<service>")
+def deploy_fleet(service):
+    """Deploy, delete or update service on all its nodes endpoint.
+
+    Query arguments: action (deploy, delete or update), batch_size and
+    health (1 or 0).
+    """
+    args = flask.request.args
+    action = args.get("action", "deploy")
+    if action not in ["deploy", "delete", "update"]:
+        flask.abort(400)
+    svc = snapshot.services.by_name.get(service)
+    if not svc:
+        flask.abort(404)
+    if (action != "delete" and not svc.deploy_script) or (
+        action != "deploy" and not svc.delete_script
+    ):
+        flask.abort(400)
+    batch_size = args.get("batch_size", str(cfg_deploy_batch_size))
+    if not batch_size.isdigit() or not int(batch_size):
+        flask.abort(400)
+    fleet_deploy = FleetDeploy(
+        svc, action, int(batch_size), args.get("health", "1") == "1"
+    )
+    finished = [d for d in fleet_deploys.values() if d.finished]
+    for old_deploy in finished[: max(len(finished) - FLEET_DEPLOY_HISTORY, 0)]:
+        del fleet_deploys[old_deploy.deploy_id]
+    fleet_deploys[fleet_deploy.deploy_id] = fleet_deploy
+    socketio.start_background_task(target=fleet_deploy.run)
+    return flask.redirect(
+        flask.url_for("fleet_deploy_status", deploy_id=fleet_deploy.deploy_id)
+    )
+
+
+@app.route("/fleet_deploy/<deploy_id>")
+def fleet_deploy_status(deploy_id):
+    """Fleet deploy progress page endpoint. Add ?json=1 for the summary."""
+    fleet_deploy = fleet_deploys.get(deploy_id)
+    if not fleet_deploy:
+        flask.abort(404)
+    if flask.request.args.get("json"):
+        return flask.Response(
+            json.dumps(fleet_deploy.summary()), mimetype="application/json"
+        )
+    return flask.render_template(
+        "fleet_deploy.jinja2",
+        fleet_deploy=fleet_deploy,
+        title=f"sillycat {fleet_deploy.action} {fleet_deploy.service.name}",
+    )
+
+
+@socketio.on("watch", namespace="/fleet_deploy")
+def fleet_deploy_watch(data):
+    """Join a fleet deploy's room and catch up on its state."""
+    fleet_deploy = fleet_deploys.get(data.get("deploy_id"))
+    if not fleet_deploy:
+        return
+    flask_socketio.join_room(fleet_deploy.deploy_id)
+    flask_socketio.emit(
+        "catchup",
+        {
+            "summary": fleet_deploy.summary(),
+            "output": fleet_deploy.catchup(),
+        },
+    )
+
+
+@socketio.on("ack", namespace="/fleet_deploy")
+def fleet_deploy_ack(data):
+    """Browser has shown a frame of deploy output."""
+    fleet_deploy = fleet_deploys.get(data.get("deploy_id"))
+    if fleet_deploy:
+        fleet_deploy.acked = max(fleet_deploy.acked, data.get("seq", 0))
+
+
+# dashboard settings are kept per viewer, in cookies
+DASHBOARD_SETTINGS = ["refresh_rate", "search_filter", "sort"]
+SETTINGS_COOKIE_AGE = 365 * 86400
+
+
+def dashboard_settings():
+    """Return the viewer's dashboard settings, which query arguments override."""
+    return {
+        name: flask.request.args.get(name, flask.request.cookies.get(name, ""))
+        for name in DASHBOARD_SETTINGS
+    }
 
 
 @app.route("/apply_settings", methods=["POST"])
 def apply_settings():
     """Save dashboard page settings endpoint."""
     print(flask.request.form)
+    response = flask.redirect(flask.url_for("index"))
     if flask.request.form.get("Submit") == "Submit_apply":
-        global refresh_rate
-        refresh_rate = flask.request.form.get("refresh_rate")
+        response.set_cookie(
+            "refresh_rate",
+            flask.request.form.get("refresh_rate", ""),
+            max_age=SETTINGS_COOKIE_AGE,
+        )
     if flask.request.form.get("Submit") == "Submit_search":
-        global search_filter
-        search_filter = flask.request.form.get("search_filter").strip()
-        print(search_filter)
-        print(type(search_filter))
-    return flask.redirect(flask.url_for("index"))
+        response.set_cookie(
+            "search_filter",
+            flask.request.form.get("search_filter", "").strip(),
+            max_age=SETTINGS_COOKIE_AGE,
+        )
+        response.set_cookie(
+            "sort", flask.request.form.get("sort", ""), max_age=SETTINGS_COOKIE_AGE
+        )
+    return response
+
 
+MERMAID_ITEM_RE = re.compile(r"(.*)\[(.*) (.*)\]")
+MERMAID_CLASS_DEFS = ["classDef good fill:#9f9;", "classDef bad fill:#f99;"]
 
-def process_mermaid_diagram(config, nodes, services):
-    """Set colors for the nodes in the mermaid diagram.
 
-    And add @ before node names.
+class MermaidDiagram:
+    """The config's mermaid diagram, parsed once and coloured by service status.
+
+    Boxes written as ID[SERVICE NODE] are service/node pairs: an @ is put
+    before the node name and the box is coloured by the service's status
+    on that node. The diagram text is parsed when the config is loaded;
+    after that, colouring it only looks up the statuses of the pairs it
+    shows and rebuilds the output only if one of them changed.
     """
-    service_names = [service["name"] for service in config.get("services")]
-    node_names = services.get_node_names()
-    diagram_lines = config.get("mermaid_diagram").split("\n")
-    out1 = []
-    out2 = ["classDef good fill:#9f9;", "classDef bad fill:#f99;"]
-    for diagram_line in diagram_lines:
-        m = re.match(r"(.*)\[(.*) (.*)\]", diagram_line)
-        if not m:
-            out1.append(diagram_line)
-        else:
-            item_mermaid_id = m.group(1)
-            item_service_name = m.group(2).replace("<br/>", "")
-            item_service_name_orig = m.group(2)
-            item_node_name = m.group(3)
-
-            if item_service_name in service_names and item_node_name in node_names:
-                out1.append(
-                    f"{item_mermaid_id}[{item_service_name_orig} fa:fa-at {item_node_name}]"
-                )
-                item_service_status = services.by_name[item_service_name].status[
-                    item_node_name
-                ]
-                if item_service_status == "active":
-                    out2.append(f"class {item_mermaid_id} good;")
-                else:
-                    out2.append(f"class {item_mermaid_id} bad;")
-            else:
-                out1.append(diagram_line)
 
-    return "\n".join(out1 + out2)
+    def __init__(self, text, service_names, node_names):
+        """Initialize class variables."""
+        self.lines = []
+        self.items = []
+        for line in text.split("\n"):
+            m = MERMAID_ITEM_RE.match(line)
+            if m:
+                mermaid_id, service_name_orig, node_name = m.groups()
+                service_name = service_name_orig.replace("<br/>", "")
+                if service_name in service_names and node_name in node_names:
+                    line = f"{mermaid_id}[{service_name_orig} fa:fa-at {node_name}]"
+                    self.items.append((mermaid_id, service_name, node_name))
+            self.lines.append(line)
+        self.statuses = None
+        self.out = None
+
+    def render(self, services):
+        """Return the diagram with boxes coloured by the statuses in services.
+
+        Pairs that haven't been polled yet are left uncoloured.
+        """
+        statuses = [
+            services.by_name[service_name].status.get(node_name)
+            for _, service_name, node_name in self.items
+        ]
+        if statuses != self.statuses:
+            class_lines = [
+                f"class {mermaid_id} {'good' if status == 'active' else 'bad'};"
+                for (mermaid_id, _, _), status in zip(self.items, statuses)
+                if status is not None
+            ]
+            self.out = "\n".join(self.lines + MERMAID_CLASS_DEFS + class_lines)
+            self.statuses = statuses
+        return self.out
 
 
 INCLUDED_DOC_SITES = [
@@ -510,46 +3634,211 @@ INCLUDED_DOC_SITES = [
 @app.route("/")
 def index():
     """Dashboard index endpoint."""
-    global services
-    config_text = pathlib.Path(cfg_services_yaml).read_text()
-    config = yaml.safe_load(config_text)
-    services = Services(config_text)
-    services.update_service_status()
-    out = make_service_node_dict()
-    nodes = Nodes(services.get_node_names())
-    doc_sites = INCLUDED_DOC_SITES + config.get("doc_sites", [])
-    nodes.update()
+    snap = snapshot
+    services = snap.services
+    nodes = snap.nodes
+    settings = dashboard_settings()
+    page = flask.request.args.get("page", "")
+    page_size = flask.request.args.get("page_size", "")
+    results = search_snapshot(
+        snap.version,
+        settings["search_filter"],
+        settings["sort"] if settings["sort"] in SEARCH_SORTS else "",
+        int(page) if page.isdigit() else 1,
+        (
+            int(page_size)
+            if page_size.isdigit() and int(page_size)
+            else DASHBOARD_PAGE_SIZE
+        ),
+        alerts.ack_version,
+    )
+    doc_sites = INCLUDED_DOC_SITES + snap.config.get("doc_sites", [])
     title = "sillycat dashboard"
     if nodes.warnings or services.warnings:
         title = "WARN sillycat dashboard"
     mermaid_diagram = None
     config_paths = [x.name for x in pathlib.Path(".").glob("*.yaml")]
     if cfg_draw_mermaid_diagram:
-        mermaid_diagram = config.get("mermaid_diagram")
-        mermaid_diagram = process_mermaid_diagram(config, nodes, services)
+        mermaid_diagram = snap.mermaid_diagram
 
     if flask.request.args.get("json"):
-        n = [node.__dict__ for node in nodes.nodes]
-        s = [service.__dict__ for service in services.all]
-        return json.dumps({"nodes": n, "services": s})
+        n = [snap.data["nodes"][node.node_name] for node in results["nodes"]]
+        s = [snap.data["services"][service.name] for service, _ in results["services"]]
+        return json.dumps(
+            {
+                "version": snap.version,
+                "matches": results["matches"],
+                "page": results["page"],
+                "pages": results["pages"],
+                "age": snap.age(),
+                "stale": snap.stale,
+                "ssh_pool": transport.stats(),
+                "agents": agents.stats(),
+                "nodes": n,
+                "services": s,
+            }
+        )
+
+    with perf.timed("phase", "render index"):
+        return flask.render_template(
+            "services.jinja2",
+            services=services,
+            results=results,
+            nodes=nodes,
+            refresh_rate=settings["refresh_rate"],
+            search_filter=settings["search_filter"],
+            sort=settings["sort"],
+            search_sorts=SEARCH_SORTS,
+            title=title,
+            doc_sites=doc_sites,
+            mermaid_diagram=mermaid_diagram,
+            cfg_draw_mermaid_diagram=cfg_draw_mermaid_diagram,
+            cfg_draw_tables=cfg_draw_tables,
+            config_paths=config_paths,
+            cfg_services_yaml=cfg_services_yaml,
+            snapshot_version=snap.version,
+            snapshot_age=snap.age(),
+            snapshot_stale=snap.stale,
+            ssh_pool_stats=transport.stats(),
+            agent_stats=agents.stats() if cfg_agent else None,
+            cfg_deploy_batch_size=cfg_deploy_batch_size,
+        )
+
+
+@app.before_request
+def start_request_timer():
+    """Note when the request started, for perf."""
+    flask.g.request_started = time.perf_counter()
+
 
+@app.after_request
+def record_request_time(response):
+    """Record how long the request took by endpoint."""
+    if flask.request.endpoint and "request_started" in flask.g:
+        perf.record(
+            "request",
+            flask.request.endpoint,
+            time.perf_counter() - flask.g.request_started,
+        )
+    return response
+
+
+@app.route("/debug/perf")
+def debug_perf():
+    """Latency histograms of sc's own work. ?json=1 for machine-readable output."""
+    report = perf.report()
+    if flask.request.args.get("json"):
+        return json.dumps(report)
     return flask.render_template(
-        "services.jinja2",
-        services=services,
-        out=out,
-        nodes=nodes,
-        refresh_rate=refresh_rate,
-        search_filter=search_filter,
-        title=title,
-        doc_sites=doc_sites,
-        mermaid_diagram=mermaid_diagram,
-        cfg_draw_mermaid_diagram=cfg_draw_mermaid_diagram,
-        cfg_draw_tables=cfg_draw_tables,
-        config_paths=config_paths,
-        cfg_services_yaml=cfg_services_yaml,
+        "perf.jinja2",
+        title="sc performance",
+        report=report,
+        buckets=PERF_BUCKETS_MS,
+        now=time.time(),
+    )
+
+
+def split_arg(name):
+    """Return a comma separated query argument as a sorted tuple (empty if unset)."""
+    value = flask.request.args.get(name, "")
+    return tuple(sorted(x for x in value.split(",") if x))
+
+
+@app.route("/api/v1/snapshot")
+def api_snapshot():
+    """Fleet snapshot json endpoint.
+
+    Query arguments (comma separated lists): fields, nodes and services
+    select what to include; q=SEARCH only includes the service/node pairs
+    that match a dashboard search; since=VERSION returns only what changed
+    since that version, if it's still recent. Supports If-None-Match and gzip.
+    "stale" is true while sc shows the state saved before it restarted.
+    """
+    snap = snapshot
+    since = flask.request.args.get("since")
+    body, etag = snapshot_api_body(
+        snap.version,
+        split_arg("fields"),
+        split_arg("nodes"),
+        split_arg("services"),
+        int(since) if since and since.isdigit() else None,
+        flask.request.args.get("q", ""),
+    )
+    headers = {"Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304, headers=headers)
+    elif "gzip" in flask.request.accept_encodings:
+        headers["Content-Encoding"] = "gzip"
+        response = flask.Response(
+            gzip_body(body), mimetype="application/json", headers=headers
+        )
+    else:
+        response = flask.Response(body, mimetype="application/json", headers=headers)
+    response.set_etag(etag)
+    return response
+
+
+@app.route("/metrics")
+def metrics():
+    """Fleet metrics from the latest snapshot in the OpenMetrics text format."""
+    body = openmetrics_body(snapshot.version, alerts.ack_version)
+    headers = {"Vary": "Accept-Encoding"}
+    if "gzip" in flask.request.accept_encodings:
+        headers["Content-Encoding"] = "gzip"
+        body = gzip_body(body)
+    return flask.Response(
+        body,
+        content_type="application/openmetrics-text; version=1.0.0; charset=utf-8",
+        headers=headers,
     )
 
 
+@app.route("/api/history")
+def api_history():
+    """Metric history endpoint.
+
+    Query arguments: node and metric for node metrics, or service and node
+    for service state transitions. start and end are unix times and default
+    to the last hour.
+    """
+    args = flask.request.args
+    try:
+        end = float(args.get("end") or time.time())
+        start = float(args.get("start") or end - 3600)
+    except ValueError:
+        flask.abort(400)
+    if not (math.isfinite(start) and math.isfinite(end)):
+        flask.abort(400)
+    node_name = args.get("node")
+    if args.get("service"):
+        out = {
+            "service": args["service"],
+            "node": node_name,
+            "transitions": history.service_transitions(
+                args["service"], node_name, start, end
+            ),
+        }
+    else:
+        metric = args.get("metric", "load")
+        if metric not in history.metrics:
+            flask.abort(400)
+        resolution, points = history.node_metric(node_name, metric, start, end)
+        out = {
+            "node": node_name,
+            "metric": metric,
+            "resolution": resolution,
+            "points": points,
+        }
+    return flask.Response(json.dumps(out), mimetype="application/json")
+
+
+@app.route("/refresh")
+def refresh():
+    """Endpoint to ask the poller for a fresh snapshot now."""
+    request_refresh()
+    return flask.redirect(flask.url_for("index"))
+
+
 @app.route("/change_config", methods=["POST"])
 def change_config():
     """Endpoint to change to a different endpoint."""
@@ -558,20 +3847,22 @@ def change_config():
         if pathlib.Path(new_config).exists():
             global cfg_services_yaml
             cfg_services_yaml = new_config
+            cancel_collection()
+            request_refresh()
     return flask.redirect(flask.url_for("index"))
 
 
-@app.route("/toggle_acknowledge_alert/<service_name>/<node_name>/<node_alert_type>")
-def toggle_acknowledge_alert(service_name, node_name, node_alert_type):
+@app.route("/toggle_acknowledge_alert/<kind>/<node_name>")
+def toggle_acknowledge_alert(kind, node_name):
     """Endpoint to toggle alert.
 
-    If the argument does not apply to the alert type, pass '-' for that argument.
+    kind is one of ALERT_KINDS, and the service name or mount point of
+    service and disk alerts is passed as the target argument.
     """
-    elem = service_name + node_name + node_alert_type
-    if elem in ACKNOWLEDGED_ALERTS:
-        ACKNOWLEDGED_ALERTS.remove(elem)
-    else:
-        ACKNOWLEDGED_ALERTS.add(elem)
+    if kind not in ALERT_KINDS:
+        flask.abort(404)
+    key = AlertKey(kind, node_name, flask.request.args.get("target", ""))
+    state_store.save("acknowledged_alerts", alerts.toggle_ack(key))
     return flask.redirect(flask.url_for("index"))
 
 
@@ -591,16 +3882,6 @@ def toggle_tables():
     return flask.redirect(flask.url_for("index"))
 
 
-def is_service_alert_acked(service_name, node_name):
-    """Return if the service alert is acknowledged."""
-    return service_name + node_name + "-" in ACKNOWLEDGED_ALERTS
-
-
-def is_node_alert_acked(node_name, node_alert_type):
-    """Return if the node alert is acknowledged."""
-    return "-" + node_name + node_alert_type in ACKNOWLEDGED_ALERTS
-
-
 def is_ok_config(sc_config):
     """Check if the argument string is a valid config."""
     try:
@@ -635,110 +3916,398 @@ def config():
             if not is_ok_config(unsafe_sc_config):
                 return flask.redirect(flask.url_for("config"))
             cfg_services_yaml = f"./config_{time_now}.yaml"
+            cancel_collection()
+            request_refresh()
             return flask.redirect(flask.url_for("index"))
 
 
 # pyxtermjs functions
 
 
-@app.route("/close_terminal")
-def close_terminal():
-    """Close terminal and redirect back to index."""
-    app.config["term_proc_exit"] = True
-    os.kill(app.config["child_pid"], 15)
-    app.config["socketio_thread"].join()
+class TerminalSession:
+    """A command running in a pty, shown in the browsers attached to its room."""
 
-    return flask.redirect(flask.url_for("index"))
+    def __init__(self, cmd):
+        """Initialize class variables."""
+        self.session_id = uuid.uuid4().hex[:12]
+        self.cmd = cmd
+        self.fd = None
+        self.child_pid = None
+        self.created = time.time()
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.pending = []
+        self.pending_bytes = 0
+        self.flush_at = None
+        self.sent = 0
+        self.acked = 0
+        self.paused_since = None
+        self.dropping = False
+        # set by ack() for the reader thread, which owns the pending output
+        self.caught_up = False
+        self.dropped_bytes = 0
+        self.total_bytes = 0
 
+    def start(self):
+        """Fork the command attached to a new pty."""
+        (child_pid, fd) = pty.fork()
+        if child_pid == 0:
+            # this is the child process fork.
+            # anything printed here will show up in the pty
+            print(" ".join(self.cmd))
+            try:
+                os.execvp(self.cmd[0], self.cmd)
+            except OSError as e:
+                print(f"*** sc: {e}", flush=True)
+            # never carry on as a copy of the server
+            os._exit(1)
+        self.child_pid = child_pid
+        self.fd = fd
+        set_winsize(fd, 50, 50)
 
-def set_winsize(fd, row, col, xpix=0, ypix=0):
-    """Set window size with termios."""
-    winsize = struct.pack("HHHH", row, col, xpix, ypix)
-    fcntl.ioctl(fd, termios.TIOCSWINSZ, winsize)
 
+# how long output is held back to be sent together with more output
+TERM_FRAME_INTERVAL = 0.02
+# output is sent as soon as this much is pending
+TERM_FRAME_BYTES = 64 * 1024
+# frames the browser hasn't written yet before we stop reading the pty
+TERM_MAX_UNACKED_FRAMES = 8
+# after being paused this long, output is read and dropped instead
+TERM_STALL_TIMEOUT = 5
+# sessions that no browser attached to within this long are forgotten
+TERM_ATTACH_TIMEOUT = 60
 
-def read_and_forward_pty_output():
-    max_read_bytes = 1024 * 20
-    while True:
-        socketio.sleep(0.01)
-        if app.config["fd"]:
+
+class TerminalManager:
+    """All terminal sessions, with a single reader for all of their ptys.
+
+    The reader thread waits on every pty with a selector and forwards
+    output to the session's socket.io room, so the number of threads
+    doesn't grow with the number of terminals.
+
+    Output is coalesced into frames of at most TERM_FRAME_BYTES, sent at
+    most TERM_FRAME_INTERVAL after the first byte arrived. Browsers ack
+    each frame once it's written; when too many frames are unacked the
+    pty isn't read, so the command blocks on its output. If that goes
+    on for TERM_STALL_TIMEOUT the output is dropped until the browser
+    catches up, and a marker is shown in its place.
+    """
+
+    def __init__(self):
+        """Initialize class variables."""
+        self.sessions = dict()
+        self.by_fd = dict()
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.reader = None
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+
+    def create(self, cmd):
+        """Return a new session for cmd, started when a browser attaches."""
+        session = TerminalSession(cmd)
+        self.sessions[session.session_id] = session
+        return session
+
+    def reap_unattached(self):
+        """Forget sessions that weren't attached within TERM_ATTACH_TIMEOUT."""
+        oldest = time.time() - TERM_ATTACH_TIMEOUT
+        with self.lock:
+            for session in list(self.sessions.values()):
+                if session.child_pid is None and session.created < oldest:
+                    self.sessions.pop(session.session_id, None)
+
+    def attach(self, session_id):
+        """Start the session's command if it isn't running yet."""
+        with self.lock:
+            # under the lock, so the session can't be reaped while starting
+            session = self.sessions.get(session_id)
+            if not session:
+                return None
+            if session.child_pid is None:
+                session.start()
+                self.by_fd[session.fd] = session
+                self.selector.register(session.fd, selectors.EVENT_READ)
+                self.wakeup()
+            if not self.reader:
+                # a daemon, as it waits on the ptys forever
+                self.reader = threading.Thread(target=self.read_loop, daemon=True)
+                self.reader.start()
+        return session
+
+    def close(self, session_id):
+        """Kill the session's command and forget the session."""
+        session = self.sessions.pop(session_id, None)
+        if not session or session.child_pid is None:
+            return
+        with self.lock:
+            self.by_fd.pop(session.fd, None)
+            if session.paused_since is None:
+                self.selector.unregister(session.fd)
             try:
-                timeout_sec = 0
-                (data_ready, _, _) = select.select(
-                    [app.config["fd"]], [], [], timeout_sec
-                )
-                if data_ready:
-                    output = os.read(app.config["fd"], max_read_bytes).decode(
-                        errors="ignore"
+                os.kill(session.child_pid, 15)
+            except ProcessLookupError:
+                pass
+            os.close(session.fd)
+        # reap the child without blocking the caller
+        socketio.start_background_task(os.waitpid, session.child_pid, 0)
+        socketio.emit("pty-exit", {}, to=session_id, namespace="/pty")
+
+    def wakeup(self):
+        """Make the reader thread look at the sessions again."""
+        os.write(self.wakeup_w, b"x")
+
+    def read_loop(self):
+        """Forward output from every pty to its session's room."""
+        while True:
+            events = self.selector.select(self.select_timeout())
+            for key, _ in events:
+                if key.fd == self.wakeup_r:
+                    os.read(self.wakeup_r, 1024)
+                    continue
+                session = self.by_fd.get(key.fd)
+                if not session:
+                    continue
+                try:
+                    output = os.read(key.fd, TERM_FRAME_BYTES)
+                except OSError:
+                    output = b""
+                if not output:
+                    session.pending.append(session.decoder.decode(b"", final=True))
+                    self.flush(session)
+                    print(
+                        f"*** terminal {session.session_id} exited "
+                        f"({session.total_bytes} bytes in {session.sent} frames, "
+                        f"{session.dropped_bytes} dropped)"
                     )
-                    socketio.emit("pty-output", {"output": output}, namespace="/pty")
-            except OSError:
-                app.config["child_pid"] = None
-                app.config["fd"] = None
-                app.config["cmd"] = "false"
-                app.config["term_proc_exit"] = False
-                print("*** bye!")
-                return
-        if app.config["term_proc_exit"]:
-            app.config["child_pid"] = None
-            app.config["fd"] = None
-            app.config["cmd"] = "false"
-            app.config["term_proc_exit"] = False
-            print("*** bye!")
+                    self.close(session.session_id)
+                    continue
+                self.buffer(session, output)
+
+            now = time.monotonic()
+            with self.lock:
+                sessions = list(self.by_fd.values())
+            for session in sessions:
+                if session.caught_up:
+                    session.caught_up = False
+                    self.catch_up(session)
+                if session.pending and (
+                    now >= session.flush_at or session.pending_bytes >= TERM_FRAME_BYTES
+                ):
+                    self.flush(session)
+                if (
+                    session.paused_since is not None
+                    and now - session.paused_since >= TERM_STALL_TIMEOUT
+                ):
+                    print(f"*** terminal {session.session_id} stalled, dropping output")
+                    session.dropping = True
+                    self.resume(session)
+
+    def select_timeout(self):
+        """Return how long the reader can wait, or None if only for a pty or wakeup."""
+        deadlines = list()
+        with self.lock:
+            for session in self.by_fd.values():
+                if session.pending:
+                    deadlines.append(session.flush_at)
+                if session.paused_since is not None:
+                    deadlines.append(session.paused_since + TERM_STALL_TIMEOUT)
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
+
+    def buffer(self, session, output):
+        """Add pty output to the session's next frame."""
+        session.total_bytes += len(output)
+        if session.dropping:
+            session.dropped_bytes += len(output)
+            return
+        if not session.pending:
+            session.flush_at = time.monotonic() + TERM_FRAME_INTERVAL
+        # the decoder keeps a partial utf-8 sequence until the rest arrives
+        session.pending.append(session.decoder.decode(output))
+        session.pending_bytes += len(output)
+
+    def flush(self, session):
+        """Send the session's pending output as one frame."""
+        output = "".join(session.pending)
+        session.pending = []
+        session.pending_bytes = 0
+        session.flush_at = None
+        if not output:
+            return
+        session.sent += 1
+        socketio.emit(
+            "pty-output",
+            {"output": output, "seq": session.sent},
+            to=session.session_id,
+            namespace="/pty",
+        )
+        if (
+            session.paused_since is None
+            and not session.dropping
+            and session.sent - session.acked >= TERM_MAX_UNACKED_FRAMES
+        ):
+            self.pause(session)
+
+    def pause(self, session):
+        """Stop reading the session's pty until the browser catches up."""
+        with self.lock:
+            if session.fd in self.by_fd and session.paused_since is None:
+                self.selector.unregister(session.fd)
+                session.paused_since = time.monotonic()
+
+    def resume(self, session):
+        """Read the session's pty again."""
+        with self.lock:
+            if session.fd in self.by_fd and session.paused_since is not None:
+                self.selector.register(session.fd, selectors.EVENT_READ)
+                session.paused_since = None
+        self.wakeup()
+
+    def catch_up(self, session):
+        """Read a session again once its browser has caught up.
+
+        Runs on the reader thread, like everything else that changes the
+        session's pending output.
+        """
+        if session.dropping:
+            session.dropping = False
+            session.flush_at = time.monotonic()
+            session.pending.append(
+                f"\r\n*** sc: dropped {session.dropped_bytes} bytes of output\r\n"
+            )
+        self.resume(session)
+
+    def ack(self, session_id, seq):
+        """A browser has written the session's output up to frame seq."""
+        session = self.sessions.get(session_id)
+        if not session:
             return
+        session.acked = max(session.acked, seq)
+        if session.sent - session.acked < TERM_MAX_UNACKED_FRAMES:
+            session.caught_up = True
+            self.wakeup()
+
+    def write(self, session_id, data):
+        """Write input to the session's pty."""
+        session = self.sessions.get(session_id)
+        if session and session.fd is not None:
+            os.write(session.fd, data)
+
+    def resize(self, session_id, rows, cols):
+        """Set the window size of the session's pty."""
+        session = self.sessions.get(session_id)
+        if session and session.fd is not None:
+            set_winsize(session.fd, rows, cols)
+
+
+terminals = TerminalManager()
+
+
+@app.route("/close_terminal/<session_id>")
+def close_terminal(session_id):
+    """Close terminal and redirect back to index."""
+    terminals.close(session_id)
+    return flask.redirect(flask.url_for("index"))
+
+
+def set_winsize(fd, row, col, xpix=0, ypix=0):
+    """Set window size with termios."""
+    winsize = struct.pack("HHHH", row, col, xpix, ypix)
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, winsize)
 
 
 @socketio.on("pty-input", namespace="/pty")
 def pty_input(data):
     """Write to the child pty. The pty sees this as if you are typing in a real terminal."""
-    if app.config["fd"]:
-        os.write(app.config["fd"], data["input"].encode())
+    terminals.write(data["session_id"], data["input"].encode())
 
 
 @socketio.on("resize", namespace="/pty")
 def resize(data):
-    if app.config["fd"]:
-        set_winsize(app.config["fd"], data["rows"], data["cols"])
+    terminals.resize(data["session_id"], data["rows"], data["cols"])
 
 
-@socketio.on("connect", namespace="/pty")
-def connect():
-    """new client connected"""
-    if app.config["child_pid"]:
-        # already started child process, don't start another
-        return
+@socketio.on("pty-ack", namespace="/pty")
+def pty_ack(data):
+    """Browser has written a frame of output to its terminal."""
+    terminals.ack(data["session_id"], data["seq"])
 
-    # create child process attached to a pty we can read from and write to
-    (child_pid, fd) = pty.fork()
-    if child_pid == 0:
-        # this is the child process fork.
-        # anything printed here will show up in the pty, including the output
-        # of this subprocess
-        print(app.config["cmd"])
-        subprocess.run(app.config["cmd"])
-    else:
-        # this is the parent process fork.
-        # store child fd and pid
-        app.config["fd"] = fd
-        app.config["child_pid"] = child_pid
-        set_winsize(fd, 50, 50)
-        s = socketio.start_background_task(target=read_and_forward_pty_output)
-        app.config["socketio_thread"] = s
+
+@socketio.on("attach", namespace="/pty")
+def attach(data):
+    """Browser attached to a terminal session: join its room, starting it if needed."""
+    if terminals.attach(data["session_id"]):
+        flask_socketio.join_room(data["session_id"])
 
 
 # end of pyxtermjs functions
 
 
-def main(services_yaml, term_program="x-terminal-emulator"):
+def main(
+    services_yaml,
+    term_program="x-terminal-emulator",
+    poll_interval=30,
+    parallelism=16,
+    node_timeout=10,
+    deploy_batch_size=5,
+    deploy_timeout=1800,
+    job_timeout=60,
+    alert_for=0,
+    agent=False,
+    agent_interval=10,
+    simulated_fleet=False,
+    facts_file="node_facts.json",
+    state_db="sc_state.sqlite",
+):
     """Start sc web service."""
     global cfg_services_yaml
     cfg_services_yaml = services_yaml
     global cfg_term_program
     cfg_term_program = term_program
+    global cfg_poll_interval
+    cfg_poll_interval = poll_interval
+    global cfg_parallelism
+    cfg_parallelism = parallelism
+    global cfg_node_timeout
+    cfg_node_timeout = node_timeout
+    global cfg_deploy_batch_size
+    cfg_deploy_batch_size = deploy_batch_size
+    global cfg_deploy_timeout
+    cfg_deploy_timeout = deploy_timeout
+    global cfg_job_timeout
+    cfg_job_timeout = job_timeout
+    global cfg_alert_for
+    cfg_alert_for = alert_for
+    global cfg_agent
+    cfg_agent = agent
+    global cfg_agent_interval
+    cfg_agent_interval = agent_interval
+    node_facts.load(facts_file)
+    if simulated_fleet:
+        import fake_fleet
+
+        global transport
+        transport = fake_fleet.FakeFleet(latency=0.05, jitter=0.1)
+    global snapshot
+    services, nodes, _ = config_cache.load(cfg_services_yaml)
+    snapshot = make_snapshot(0, services, nodes, 0)
+    # with the reloader on, only poll from the process that serves requests
+    if os.environ.get("WERKZEUG_RUN_MAIN"):
+        if state_db:
+            state_store.open(state_db)
+            alerts.restore_acked(state_store.get("acknowledged_alerts", []))
+            state_store.restore_history(
+                history,
+                {node.node_name for node in nodes.nodes},
+                {(s.name, n) for s in services.all for n in s.nodes},
+            )
+            snapshot = state_store.restore_snapshot(services, nodes) or snapshot
+        # a daemon, so that reloads and Ctrl-C don't wait for it
+        threading.Thread(target=poller, daemon=True).start()
+    remember_snapshot(snapshot)
     socketio.run(app, debug=True, port=1234, host="127.0.0.1")
 
 
 if __name__ == "__main__":
-    global refresh_rate
-    refresh_rate = ""
     argh.dispatch_command(main)
@@ -0,0 +1,138 @@
+"""Measure how sc scales with the number of nodes and services.
+
+Runs poll cycles and dashboard requests against a simulated fleet
+(fake_fleet.FakeFleet) and prints a table of poll cycle wall time,
+index() latency and memory for each fleet size, e.g.:
+
+    python bench.py --nodes 10,200,2000 --services 10,100 --latency 0.02
+"""
+
+import contextlib
+import io
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import argh
+import tabulate
+import yaml
+
+import app
+import fake_fleet
+
+
+def fleet_config(node_count, service_count, nodes_per_service, seed):
+    """Return a services yaml with services spread over made up nodes."""
+    rng = random.Random(seed)
+    node_names = [f"node-{i:05}.sim" for i in range(node_count)]
+    services = []
+    for i in range(service_count):
+        k = min(nodes_per_service, node_count)
+        services.append({"name": f"svc-{i:04}", "nodes": rng.sample(node_names, k)})
+    # every node runs at least one service, so that every node is polled
+    for i, node_name in enumerate(node_names):
+        service = services[i % service_count]
+        if node_name not in service["nodes"]:
+            service["nodes"].append(node_name)
+    return yaml.safe_dump({"services": services})
+
+
+def measure(config, fleet, polls, requests):
+    """Return (poll times, index() times, memory MB) for a config and fleet."""
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
+        f.write(config)
+    app.cfg_services_yaml = f.name
+    app.config_cache = app.ConfigCache()
+    app.history = app.History()
+    app.alerts = app.Alerts()
+    app.poll_schedule = app.PollSchedule()
+    app.transport = fleet
+    tracemalloc.start()
+    poll_times = []
+    # the polls print a table of every service, which isn't what's measured
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(polls):
+            time_now = time.perf_counter()
+            app.poll_fleet(force=True)
+            poll_times.append(time.perf_counter() - time_now)
+        memory_mb = tracemalloc.get_traced_memory()[0] / 1e6
+        tracemalloc.stop()
+        client = app.app.test_client()
+        index_times = []
+        for _ in range(requests):
+            time_now = time.perf_counter()
+            assert client.get("/").status_code == 200
+            index_times.append(time.perf_counter() - time_now)
+    os.unlink(f.name)
+    return poll_times, index_times, memory_mb
+
+
+@argh.arg("--nodes", help="comma separated node counts")
+@argh.arg("--services", help="comma separated service counts")
+def main(
+    nodes="10,200,2000",
+    services="10,100",
+    nodes_per_service=3,
+    latency=0.0,
+    jitter=0.0,
+    failure_rate=0.0,
+    timeout_rate=0.0,
+    node_timeout=1,
+    parallelism=16,
+    polls=3,
+    requests=5,
+    seed=0,
+):
+    """Print poll, index() and memory numbers for each fleet size."""
+    app.cfg_node_timeout = node_timeout
+    app.cfg_parallelism = parallelism
+    rows = []
+    for node_count in [int(x) for x in nodes.split(",")]:
+        for service_count in [int(x) for x in services.split(",")]:
+            config = fleet_config(node_count, service_count, nodes_per_service, seed)
+            fleet = fake_fleet.FakeFleet(
+                latency=latency,
+                jitter=jitter,
+                failure_rate=failure_rate,
+                timeout_rate=timeout_rate,
+                seed=seed,
+            )
+            poll_times, index_times, memory_mb = measure(config, fleet, polls, requests)
+            body, _ = app.snapshot_api_body(app.snapshot.version, (), (), (), None)
+            rows.append(
+                [
+                    node_count,
+                    service_count,
+                    sum(len(s.nodes) for s in app.config_cache.services.all),
+                    poll_times[0] * 1000,
+                    statistics.median(poll_times[1:] or poll_times) * 1000,
+                    statistics.median(index_times) * 1000,
+                    max(index_times) * 1000,
+                    memory_mb,
+                    len(body) / 1000,
+                ]
+            )
+    print(
+        tabulate.tabulate(
+            rows,
+            headers=[
+                "nodes",
+                "services",
+                "pairs",
+                "first poll ms",
+                "poll ms",
+                "index ms",
+                "index max ms",
+                "memory MB",
+                "snapshot api KB",
+            ],
+            floatfmt=".1f",
+        )
+    )
+
+
+if __name__ == "__main__":
+    argh.dispatch_command(main)
@@ -0,0 +1,240 @@
+"""A simulated fleet for running sc without real nodes.
+
+FakeFleet has the same methods as app.SSHPool and can be put in its
+place as app.transport. Instead of running scripts over ssh it answers
+the metrics and systemctl sections they ask for with made up output in
+the format of the real commands, after an optional delay and with
+optional failures and timeouts.
+"""
+
+import random
+import shlex
+import threading
+import time
+
+import app
+
+
+class FakeNode:
+    """Made up but stable state of one simulated node."""
+
+    def __init__(self, node_name, rng):
+        """Initialize class variables."""
+        self.node_name = node_name
+        self.mem_total_kb = rng.choice([4, 8, 16, 32, 64]) * 1024 * 1024
+        self.mem_used_kb = int(self.mem_total_kb * rng.uniform(0.1, 0.6))
+        self.cpus = rng.choice([2, 4, 8, 16])
+        self.load = round(rng.uniform(0, self.cpus * 0.7), 2)
+        self.uptime_s = rng.uniform(60, 90 * 86400)
+        self.disks = [
+            ("/dev/sda1", "/", rng.randint(10, 500) * 1024 * 1024),
+            ("/dev/sdb1", "/data", rng.randint(100, 4000) * 1024 * 1024),
+        ]
+        self.disk_used_pct = [rng.uniform(0.1, 0.95) for _ in self.disks]
+        self.boot_id = "%032x" % rng.getrandbits(128)
+        self.units = dict()
+        self.rng = rng
+
+    def unit(self, name):
+        """Return the state of a unit, making one up the first time."""
+        if name not in self.units:
+            active = self.rng.random() > 0.05
+            self.units[name] = {
+                "active": active,
+                "changed_s": self.rng.uniform(0, self.uptime_s),
+                "main_pid": self.rng.randint(100, 60000) if active else 0,
+                "memory": self.rng.randint(10, 2000) * 1000000,
+                "cpu_ns": self.rng.randint(1, 10**6) * 10**9,
+            }
+        return self.units[name]
+
+    def meminfo(self, key):
+        """Return a /proc/meminfo line."""
+        if key == "MemTotal":
+            return f"MemTotal:       {self.mem_total_kb} kB\n"
+        return f"MemAvailable:   {self.mem_total_kb - self.mem_used_kb} kB\n"
+
+    def df(self, mounts):
+        """Return df -P -k output, for all filesystems if mounts is empty."""
+        lines = ["Filesystem     1024-blocks      Used Available Capacity Mounted on"]
+        if not mounts:
+            lines.append("tmpfs            1638400      1200   1637200   1% /run")
+        for (device, mounted_on, size), used_pct in zip(self.disks, self.disk_used_pct):
+            if mounts and mounted_on not in mounts:
+                continue
+            used = int(size * used_pct)
+            lines.append(
+                f"{device:<14} {size:>10} {used:>9} {size - used:>9} {int(used_pct * 100):>3}% {mounted_on}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def systemctl_show(self, properties, names):
+        """Return systemctl show output for units."""
+        blocks = []
+        for name in names:
+            unit = self.unit(name)
+            values = {
+                "LoadState": "loaded",
+                "ActiveState": "active" if unit["active"] else "inactive",
+                "SubState": "running" if unit["active"] else "dead",
+                "StateChangeTimestampMonotonic": str(int(unit["changed_s"] * 1e6)),
+                "MainPID": str(unit["main_pid"]),
+                "MemoryCurrent": str(unit["memory"] if unit["active"] else 2**64 - 1),
+                "CPUUsageNSec": str(unit["cpu_ns"]),
+            }
+            blocks.append("\n".join(f"{p}={values.get(p, '')}" for p in properties))
+        return "\n\n".join(blocks) + "\n"
+
+    def section(self, name, command):
+        """Return the output of one section of a batched script."""
+        if name == "boot_id":
+            return f"{self.boot_id}\n"
+        if name == "meminfo":
+            return self.meminfo("MemAvailable")
+        if name == "mem_total":
+            return self.meminfo("MemTotal")
+        if name == "loadavg":
+            return f"{self.load:.2f} {self.load:.2f} {self.load:.2f} 1/500 12345\n"
+        if name == "cpus":
+            return f"{self.cpus}\n"
+        if name == "kernel":
+            return "6.1.0-13-amd64\n"
+        if name in ["df", "df_all"]:
+            return self.df(shlex.split(command)[3:])
+        if name == "proc_uptime":
+            return f"{self.uptime_s:.2f} {self.uptime_s * self.cpus:.2f}\n"
+        if name == "show":
+            words = shlex.split(command)
+            properties = words[words.index("-p") + 1].split(",")
+            return self.systemctl_show(properties, words[words.index("-p") + 2 :])
+        return ""
+
+    def reboot(self):
+        """Come back up with a new boot id and no services changed yet."""
+        self.boot_id = "%032x" % self.rng.getrandbits(128)
+        self.uptime_s = 60
+        for unit in self.units.values():
+            unit["changed_s"] = 0
+
+    def systemctl(self, action, name):
+        """Change a unit's state like systemctl start/stop/restart would."""
+        unit = self.unit(name)
+        unit["active"] = action != "stop"
+        unit["changed_s"] = self.uptime_s
+        unit["main_pid"] = self.rng.randint(100, 60000) if unit["active"] else 0
+
+
+class FakeFleet:
+    """Simulated nodes answering the scripts sc runs, in place of SSHPool.
+
+    Every call waits latency seconds (plus up to jitter more). A call fails
+    with probability failure_rate, and with probability timeout_rate it
+    hangs until its deadline. Nodes in down never answer.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        jitter=0.0,
+        failure_rate=0.0,
+        timeout_rate=0.0,
+        down=(),
+        seed=0,
+    ):
+        """Initialize class variables."""
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.down = set(down)
+        self.seed = seed
+        self.nodes = dict()
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.failures = 0
+
+    def node(self, node_name):
+        """Return the simulated node, creating it the first time."""
+        with self.lock:
+            if node_name not in self.nodes:
+                rng = random.Random(f"{self.seed}:{node_name}")
+                self.nodes[node_name] = FakeNode(node_name, rng)
+            return self.nodes[node_name]
+
+    def call(self, node_name, deadline=None):
+        """Simulate the network and failures of one call to node."""
+        with self.lock:
+            self.calls += 1
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            roll = self.rng.random()
+        if node_name in self.down or roll < self.timeout_rate:
+            if deadline:
+                time.sleep(max(deadline - time.time(), 0))
+            with self.lock:
+                self.failures += 1
+            raise app.TransportError(f"{node_name}: timed out")
+        time.sleep(delay)
+        if roll < self.timeout_rate + self.failure_rate:
+            with self.lock:
+                self.failures += 1
+            raise app.TransportError(f"{node_name}: command failed")
+
+    def acquire(self, node_name):
+        """Return True unless the node is down."""
+        return node_name not in self.down
+
+    def run_script(self, node_name, script, deadline):
+        """Return the output a batched sc script would print on the node."""
+        self.call(node_name, deadline)
+        node = self.node(node_name)
+        out = []
+        skipping = False
+        for line in script.split("\n"):
+            # the node facts are only printed if the boot id isn't the known one
+            if line.startswith("if ") and "boot_id" in line:
+                skipping = shlex.split(line)[4] == node.boot_id
+            elif line == "fi":
+                skipping = False
+            if skipping or not line.startswith(f"echo '{app.SECTION_MARKER}"):
+                continue
+            header, _, command = line.partition("; ")
+            name = header[len(f"echo '{app.SECTION_MARKER}") : -1]
+            out.append(f"{app.SECTION_MARKER}{name}\n{node.section(name, command)}")
+        return "".join(out)
+
+    def run(self, node_name, *args, deadline):
+        """Run systemctl start/stop/restart on the simulated node."""
+        self.call(node_name, deadline)
+        if len(args) == 3 and args[0] == "systemctl":
+            self.node(node_name).systemctl(args[1], args[2])
+        return ""
+
+    def argv(self, node_name, *args):
+        """Return a local command line that says what would have been run."""
+        text = f"[simulated {node_name}] {' '.join(args) or 'shell'}"
+        return ["echo", text]
+
+    def command(self, node_name, *args):
+        """Return a local command line that says what would have been run."""
+        return self.argv(node_name, *args)
+
+    def script_prefix(self, node_name, program):
+        """Return a prefix for deploy script lines that only prints them."""
+        return f"echo [simulated] {program}"
+
+    def expire_idle(self):
+        """Nothing to expire."""
+
+    def close_all(self):
+        """Nothing to close."""
+
+    def stats(self):
+        """Return counters in the same shape as SSHPool.stats()."""
+        return {
+            "open_masters": 0,
+            "opened": 0,
+            "reuses": self.calls,
+            "reconnects": 0,
+            "failures": self.failures,
+        }
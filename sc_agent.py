@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""sc agent: stream node metrics and service state to sc as JSON lines.
+
+sc runs this on every node over one long-lived ssh session when it's
+started with --agent, and reads a line from it every --interval seconds
+instead of running commands over ssh on each poll. It can also be run by
+hand to see what it sends. Only the python standard library is used, so
+nodes need nothing but python3.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+def read_meminfo():
+    """Return /proc/meminfo as a dict of kB values."""
+    meminfo = dict()
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            meminfo[key] = int(value.split()[0])
+    return meminfo
+
+
+def read_uptime():
+    """Return the seconds since boot from /proc/uptime."""
+    with open("/proc/uptime") as f:
+        return float(f.read().split()[0])
+
+
+def read_load():
+    """Return the one minute load average."""
+    with open("/proc/loadavg") as f:
+        return float(f.read().split()[0])
+
+
+def format_uptime(seconds):
+    """Format an uptime like uptime(1) does, e.g. '3 days', '2:03' or '5 min'."""
+    days = int(seconds // 86400)
+    if days:
+        return f"{days} day{'s' if days > 1 else ''}"
+    hours = int(seconds % 86400 // 3600)
+    minutes = int(seconds % 3600 // 60)
+    if hours:
+        return f"{hours}:{minutes:02}"
+    return f"{minutes} min"
+
+
+def read_df():
+    """Return [device, mount point, used kB, available kB] for mounted devices."""
+    df = []
+    with open("/proc/mounts") as f:
+        for line in f:
+            device, mounted_on = line.split()[:2]
+            if not device.startswith("/dev/"):
+                continue
+            # spaces in mount points are escaped in /proc/mounts
+            mounted_on = mounted_on.replace("\\040", " ")
+            try:
+                st = os.statvfs(mounted_on)
+            except OSError:
+                continue
+            used = (st.f_blocks - st.f_bfree) * st.f_frsize // 1024
+            avail = st.f_bavail * st.f_frsize // 1024
+            df.append([device, mounted_on, used, avail])
+    return df
+
+
+def systemctl_show(units, properties):
+    """Return systemctl show output for units, in the order given."""
+    if not units:
+        return ""
+    p = subprocess.run(
+        ["systemctl", "show", "--no-page", "-p", properties, *units],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    return p.stdout
+
+
+def sample():
+    """Return the node metrics, in the units sc shows them in."""
+    meminfo = read_meminfo()
+    uptime_s = read_uptime()
+    return {
+        "time": time.time(),
+        "mem_used": (meminfo["MemTotal"] - meminfo["MemAvailable"]) // 1000,
+        "mem_avail": meminfo["MemTotal"] // 1000,
+        "uptime": format_uptime(uptime_s),
+        "uptime_s": uptime_s,
+        "load": read_load(),
+        "cpus": os.cpu_count() or 0,
+        "df": read_df(),
+    }
+
+
+def main():
+    """Print a sample every interval until stdout goes away."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--interval", type=float, default=10)
+    parser.add_argument("--properties", default="LoadState,ActiveState,SubState")
+    parser.add_argument("units", nargs="*")
+    args = parser.parse_args()
+
+    last_show = None
+    try:
+        while True:
+            update = sample()
+            # service state is only sent when it changed
+            show = systemctl_show(args.units, args.properties)
+            if show != last_show:
+                update["show"] = show
+                last_show = show
+            sys.stdout.write(json.dumps(update, separators=(",", ":")) + "\n")
+            sys.stdout.flush()
+            time.sleep(args.interval)
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+
+
+if __name__ == "__main__":
+    main()
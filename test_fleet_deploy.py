@@ -0,0 +1,59 @@
+"""Regression tests for fleet deploys reporting failed scripts and output."""
+
+import pathlib
+import tempfile
+
+import app
+import fake_fleet
+
+
+class LocalFleet(fake_fleet.FakeFleet):
+    """A simulated fleet whose deploy sessions run in a local bash."""
+
+    def script_prefix(self, node_name, program):
+        """Return a prefix that drops the ssh host and runs the rest locally."""
+        return "sh -c 'shift; exec \"$@\"' sc"
+
+
+def run_deploy(monkeypatch, script, action="deploy", nodes=("node-1", "node-2")):
+    """Return the states of a one node per batch rollout of script."""
+    monkeypatch.setattr(app, "transport", LocalFleet())
+    service = app.Service(
+        {"name": "sc-test", "nodes": list(nodes), "deploy": script, "delete": script}
+    )
+    fleet_deploy = app.FleetDeploy(service, action, batch_size=1, health_check=False)
+    fleet_deploy.run()
+    scripts_dir = pathlib.Path(tempfile.gettempdir())
+    assert not list(scripts_dir.glob(f"fleet.{fleet_deploy.deploy_id}.*"))
+    return fleet_deploy.state
+
+
+def test_failed_script_fails_node_and_stops_rollout(monkeypatch):
+    state = run_deploy(monkeypatch, "echo before\nexit 7\necho after\n")
+    assert state == {"node-1": "failed", "node-2": "skipped"}
+
+
+def test_failed_delete_script_fails_node(monkeypatch):
+    state = run_deploy(monkeypatch, "false\n", action="delete", nodes=["node-1"])
+    assert state == {"node-1": "failed"}
+
+
+def test_successful_script_is_ok(monkeypatch):
+    state = run_deploy(monkeypatch, "true\n")
+    assert state == {"node-1": "ok", "node-2": "ok"}
+
+
+def test_output_is_sent_in_frames():
+    service = app.Service({"name": "sc-test", "nodes": ["node-1"], "deploy": "true\n"})
+    fleet_deploy = app.FleetDeploy(service, "deploy", batch_size=1, health_check=False)
+    fleet_deploy.add_output("node-1", "one\n")
+    fleet_deploy.add_output("node-1", "two\n")
+    assert fleet_deploy.take() == [["node-1", "one\n"], ["node-1", "two\n"]]
+    fleet_deploy.add_output("node-1", "three\n")
+    # a new watcher gets what was sent, the next frame has the rest
+    assert fleet_deploy.catchup() == {"node-1": "one\ntwo\n"}
+    for i in range(app.FLEET_DEPLOY_OUTPUT_LINES):
+        fleet_deploy.add_output("node-1", f"{i}\n")
+    lines = fleet_deploy.take()
+    assert lines[0] == ["node-1", "*** sc: dropped 1 lines\n"]
+    assert len(lines) == app.FLEET_DEPLOY_OUTPUT_LINES + 1